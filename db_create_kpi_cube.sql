@@ -0,0 +1,20 @@
+-- Create KPI_Cube table (pre-aggregated hospital x department x doctor x indicator x month)
+-- '*' in a dimension column means "all" (rolled-up cell)
+CREATE TABLE IF NOT EXISTS "KPI_Cube" (
+    id bigint generated by default as identity primary key,
+    updated_at timestamp with time zone default timezone('utc'::text, now()) not null,
+    hospital text not null,
+    department text not null,
+    doctor text not null,
+    indicator_name text not null,
+    month text not null,
+    numerator integer,
+    denominator integer,
+    value double precision,
+    UNIQUE(hospital, department, doctor, indicator_name, month)
+);
+
+ALTER TABLE "KPI_Cube" ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY "Allow public read/write access" ON "KPI_Cube"
+FOR ALL USING (true) WITH CHECK (true);
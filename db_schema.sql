@@ -2,6 +2,7 @@
 -- WARNING: This deletes all existing data in these tables.
 DROP TABLE IF EXISTS "KPI" CASCADE;
 DROP TABLE IF EXISTS "KPI_Detail" CASCADE;
+DROP TABLE IF EXISTS "KPI_Cube" CASCADE;
 
 -- Create KPI Table (Aggregated Data)
 CREATE TABLE "KPI" (
@@ -39,12 +40,35 @@ CREATE TABLE "KPI_Detail" (
     discharge_date timestamp with time zone,
     op_start timestamp with time zone,
     op_end timestamp with time zone,
-    abnormal_reason text
+    abnormal_reason text,
+    source_system text,
+    procedure_id text,
+    row_key text UNIQUE,  -- source_system|procedure_id|indicator_name
+    row_hash text         -- SHA-256 of the row content, used for diff-only sync
+);
+
+CREATE INDEX ON "KPI_Detail" (source_system);
+
+-- Create KPI_Cube Table (Pre-aggregated hospital x department x doctor x indicator x month)
+-- '*' in a dimension column means "all" (rolled-up cell)
+CREATE TABLE "KPI_Cube" (
+    id bigint generated by default as identity primary key,
+    updated_at timestamp with time zone default timezone('utc'::text, now()) not null,
+    hospital text not null,
+    department text not null,
+    doctor text not null,
+    indicator_name text not null,
+    month text not null,
+    numerator integer,
+    denominator integer,
+    value double precision,
+    UNIQUE(hospital, department, doctor, indicator_name, month)
 );
 
 -- Enable RLS
 ALTER TABLE "KPI" ENABLE ROW LEVEL SECURITY;
 ALTER TABLE "KPI_Detail" ENABLE ROW LEVEL SECURITY;
+ALTER TABLE "KPI_Cube" ENABLE ROW LEVEL SECURITY;
 
 -- Create Policies
 CREATE POLICY "Allow public read/write access" ON "KPI"
@@ -52,3 +76,6 @@ FOR ALL USING (true) WITH CHECK (true);
 
 CREATE POLICY "Allow public read/write access" ON "KPI_Detail"
 FOR ALL USING (true) WITH CHECK (true);
+
+CREATE POLICY "Allow public read/write access" ON "KPI_Cube"
+FOR ALL USING (true) WITH CHECK (true);
@@ -0,0 +1,7 @@
+-- Add deterministic row key and content hash to KPI_Detail table
+ALTER TABLE "KPI_Detail" ADD COLUMN IF NOT EXISTS "source_system" text;
+ALTER TABLE "KPI_Detail" ADD COLUMN IF NOT EXISTS "procedure_id" text;
+ALTER TABLE "KPI_Detail" ADD COLUMN IF NOT EXISTS "row_key" text;
+ALTER TABLE "KPI_Detail" ADD COLUMN IF NOT EXISTS "row_hash" text;
+CREATE UNIQUE INDEX IF NOT EXISTS "KPI_Detail_row_key_key" ON "KPI_Detail" (row_key);
+CREATE INDEX IF NOT EXISTS "KPI_Detail_source_system_idx" ON "KPI_Detail" (source_system);
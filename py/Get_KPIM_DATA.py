@@ -1,68 +1,97 @@
 import asyncio
+import re
 import pandas as pd
-import matplotlib.pyplot as plt
-from datetime import datetime, timedelta
-from fhirpy import AsyncFHIRClient
-import urllib3
-
-# 忽略 SSL 警告
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+from datetime import date, datetime, timedelta
+from fhir_client import FHIRClient
+import http_capture
+from run_journal import RunJournal
+import run_metrics as metrics
+import run_profile
+from fhir_paging import iter_pages, fetch_pages
+from supabase_upload import load_env, row_key, keyed_row, fetch_stored_hashes, BatchUploader, KPISummary
+from kpi_cube import KPICube
+import numpy as np
+from kpi_stats import analyze_cube, cube_matrix, p_chart_limits
+from rolling_rates import RollingRates, WINDOWS
+from render_charts import headless, show, render_batch, trend_job, kpi_jobs
 
 # ==========================================
 # 1. 設定參數
 # ==========================================
 FHIR_SERVER_URL = "https://launch.smarthealthit.org/v/r4/fhir"
 START_DATE = (datetime.now() - timedelta(days=180)).strftime('%Y-%m-%d')
-RISK_THRESHOLD = 2.0 
+RISK_THRESHOLD = 2.0 # 僅作為趨勢圖參考線；異常判定改用漏斗圖控制線 (kpi_stats)
+PAGE_SIZE = 200
+# True: 每抓完一頁 Procedure 就運算並交給背景上傳 Supabase (KPI / KPI_Detail)
+PIPELINE_UPLOAD = False
+INDICATOR_NAME = "術後48小時死亡率"
+INDICATOR_DEF = "手術後死亡人數 / 手術總次數"
 
-async def fetch_by_ids(client, resource_type, id_list):
-    """通用函式：利用 _id 參數批次抓取資源"""
+async def fetch_by_ids(client, journal, resource_type, id_list, tag='', failed=None):
+    """通用函式：利用 _id 參數批次抓取資源 (每批結果寫入日誌，tag 用來區分不同呼叫)
+    重試後仍失敗的批次會把日誌鍵值加入 failed：這些 Procedure 缺資料被略過，不代表已刪除"""
     if not id_list: return []
-    unique_ids = list(set(id_list))
-    fetched_resources = []
+    unique_ids = sorted(set(id_list)) # 排序確保續跑時分批方式一致
     chunk_size = 50
-    for i in range(0, len(unique_ids), chunk_size):
+
+    async def fetch_chunk(i):
+        key = f"{resource_type}:{tag}{i // chunk_size}"
+        if journal.has('ids', key):
+            return journal.get('ids', key)
         chunk = unique_ids[i:i + chunk_size]
         ids_str = ",".join(chunk)
         try:
-            res = await client.resources(resource_type).search(_id=ids_str).fetch_all()
-            fetched_resources.extend(res)
-        except Exception: pass
-    return fetched_resources
+            res = await fetch_pages(client, resource_type, {'_id': ids_str, '_count': chunk_size})
+            journal.record('ids', key, res)
+            return res
+        except http_capture.ReplayMiss:
+            raise   # 錄製檔缺這個請求：重播結果不完整，不能當成查無資料繼續
+        except Exception as e:
+            print(f"   ⚠️ {resource_type} 批次查詢失敗 ({len(chunk)} 筆): {type(e).__name__}")
+            if failed is not None: failed.append(key)
+            return []
+
+    results = await asyncio.gather(*[fetch_chunk(i) for i in range(0, len(unique_ids), chunk_size)])
+    return [r for res in results for r in res]
 
-async def fetch_surgery_data():
+async def fetch_surgery_data(failed=None):
+    """回傳 (procedures, patients, encounters)；補抓失敗的批次鍵值加入 failed"""
     print(f"🔄 連接至伺服器: {FHIR_SERVER_URL}")
-    client = AsyncFHIRClient(url=FHIR_SERVER_URL)
+    client = FHIRClient(url=FHIR_SERVER_URL)
+    journal = RunJournal('fetch_surgery_data', meta={'server': FHIR_SERVER_URL, 'start_date': START_DATE})
     
     # 1. 抓 Procedure
     print("📥 步驟 1/3: 撈取手術資料 (Procedure)...")
-    procedures = await client.resources('Procedure') \
-        .search(date=f"ge{START_DATE}") \
-        .limit(200) \
-        .fetch_all()
+    procedures = await fetch_pages(client, 'Procedure', {'date': f"ge{START_DATE}", '_count': PAGE_SIZE}, journal)
         
-    if not procedures: return [], [], []
+    if not procedures:
+        journal.finish()
+        return [], [], []
 
     # 2. 收集 ID
     pat_ids = [p.get('subject', {}).get('reference', '').split('/')[-1] for p in procedures if p.get('subject')]
     enc_ids = [p.get('encounter', {}).get('reference', '').split('/')[-1] for p in procedures if p.get('encounter')]
 
     # 3. 補抓
+    failed = [] if failed is None else failed
     print(f"📥 步驟 2/3: 補抓 {len(set(pat_ids))} 筆病人資料...")
-    patients = await fetch_by_ids(client, 'Patient', pat_ids)
+    patients = await fetch_by_ids(client, journal, 'Patient', pat_ids, failed=failed)
     
     print(f"📥 步驟 3/3: 補抓 {len(set(enc_ids))} 筆住院資料...")
-    encounters = await fetch_by_ids(client, 'Encounter', enc_ids)
+    encounters = await fetch_by_ids(client, journal, 'Encounter', enc_ids, failed=failed)
     
+    if failed:
+        # 保留日誌：重新執行時只補抓失敗的批次
+        journal.close()
+        print(f"⚠️ {len(failed)} 個批次查詢失敗，相關手術未納入本次統計；重新執行即可從日誌續抓 ({journal.path})")
+    else:
+        journal.finish()
     return procedures, patients, encounters
 
-def process_data(procedures, patients_list, encounters_list):
-    print("\n⚙️ 正在進行指標運算 (ETL)...")
-    
-    patients_map = {p.id: p for p in patients_list}
-    encounters_map = {p.id: p for p in encounters_list}
-    
-    processed_list = []
+def process_records(procedures, patients_list, encounters_list, debug_rows=3):
+    """逐筆產出指標運算結果 (dict)，供 DataFrame 或串流上傳使用"""
+    patients_map = {p['id']: p for p in patients_list}
+    encounters_map = {p['id']: p for p in encounters_list}
     
     for i, proc in enumerate(procedures):
         try:
@@ -76,7 +105,7 @@ def process_data(procedures, patients_list, encounters_list):
             if not patient or not encounter: continue
 
             # --- 🔍 DEBUG: 檢查前 3 筆的住院代碼長什麼樣 ---
-            if i < 3:
+            if i < debug_rows:
                 raw_class = encounter.get('class')
                 print(f"   [Debug Case {i}] Encounter Class 資料結構: {raw_class}")
 
@@ -94,6 +123,7 @@ def process_data(procedures, patients_list, encounters_list):
             is_numerator = False
             event_type = "存活"
             event_time = None
+            abnormal_reason = None   # 寫入 KPI_Detail 的文字 (與 Next.js syncFhirData 相同)
             
             # 1. 檢查死亡時間
             death_str = patient.get('deceasedDateTime')
@@ -104,6 +134,7 @@ def process_data(procedures, patients_list, encounters_list):
                     is_numerator = True
                     event_type = "🔴 術後死亡"
                     event_time = death_time
+                    abnormal_reason = "術後48小時內死亡"
 
             # 2. 檢查病危出院
             if not is_numerator:
@@ -120,6 +151,7 @@ def process_data(procedures, patients_list, encounters_list):
                             is_numerator = True
                             event_type = "🟠 病危出院"
                             event_time = disch_time
+                            abnormal_reason = "病危出院"
 
             # --- 醫師與名稱 ---
             doctor_name = "Unknown"
@@ -129,52 +161,205 @@ def process_data(procedures, patients_list, encounters_list):
                 doctor_name = actor.get('display') or actor.get('reference', 'Unknown')
 
             op_name = proc.get('code', {}).get('coding', [{}])[0].get('display', 'Surgery')
+            department = encounter.get('serviceProvider', {}).get('display') or "Unknown Department"
+            hospital = re.match(r'【(.+?)】', department) # 科別名稱格式: 【醫院】科別
+            period = encounter.get('period', {})
 
-            processed_list.append({
+            yield {
                 'OpDate': op_end.date(),
                 'Month': op_end.strftime('%Y-%m'),
                 'Doctor': doctor_name,
+                'Department': department,
+                'Hospital': hospital.group(1) if hospital else "Unknown Hospital",
                 'OpName': op_name,
                 'IsNumerator': 1 if is_numerator else 0,
                 'EventType': event_type,
                 'EventTime': event_time,
-                'PatientID': pat_ref
-            })
+                'AbnormalReason': abnormal_reason,
+                'PatientID': pat_ref,
+                'ProcedureID': proc.get('id'),
+                'Gender': patient.get('gender'),
+                'BirthDate': patient.get('birthDate'),
+                'OpEnd': op_end_str,
+                'AdmissionDate': period.get('start'),
+                'DischargeDate': period.get('end')
+            }
             
         except Exception: continue
 
-    return pd.DataFrame(processed_list)
+def process_data(procedures, patients_list, encounters_list):
+    print("\n⚙️ 正在進行指標運算 (ETL)...")
+    with metrics.span('etl'):
+        df = pd.DataFrame(list(process_records(procedures, patients_list, encounters_list)))
+    metrics.add_rows('etl', len(df))
+    return df
+
+def to_detail_row(rec):
+    """ETL 結果 → KPI_Detail 欄位 (含 row_key / row_hash)
+    欄位與值的格式須和 Next.js 的 syncFhirData (src/app/actions/sync-data.ts) 完全相同，
+    兩邊寫入同一個 row_key 時 row_hash 才會一致，不會互相覆寫"""
+    is_bad = rec['IsNumerator'] == 1
+    return keyed_row({
+        "department": rec['Department'],
+        "doctor": rec['Doctor'],
+        "indicator_name": INDICATOR_NAME,
+        "indicator_def": INDICATOR_DEF,
+        "unit": "%",
+        "status": "異常" if is_bad else "正常",
+        "value": rec['IsNumerator'],
+        "numerator": rec['IsNumerator'],
+        "denominator": 1,
+        "patient_id": rec['PatientID'],
+        "patient_gender": rec['Gender'],
+        "patient_birthday": rec['BirthDate'],
+        "report_date": rec['OpEnd'],
+        "admission_date": rec['AdmissionDate'],
+        "discharge_date": rec['DischargeDate'],
+        "op_end": rec['OpEnd'],
+        "abnormal_reason": rec['AbnormalReason'] if is_bad else None
+    }, FHIR_SERVER_URL, rec['ProcedureID'])
+
+def update_aggregates(cube, rolling, records):
+    """把一批 ETL 結果加入立方體與滾動視窗 (以 row_key 識別，重複同步不會重複計算)；
+    滾動視窗整批依單位彙總後一次更新"""
+    rolling_rows = []
+    for rec in records:
+        key = row_key(FHIR_SERVER_URL, rec['ProcedureID'], INDICATOR_NAME)
+        cube.add(key, rec['Hospital'], rec['Department'], rec['Doctor'], INDICATOR_NAME, rec['Month'],
+                 rec['IsNumerator'], 1)
+        rolling_rows.append((key, ['全院', ('hospital', rec['Hospital']), ('doctor', rec['Doctor'])],
+                             rec['OpDate'].toordinal(), rec['IsNumerator'], 1))
+    rolling.add_many(rolling_rows)
+
+async def sync_pipelined(cube, rolling, failed):
+    """管線模式：每頁 Procedure 補抓關聯資源、運算後立即交給背景上傳器，
+    上傳與下一頁的 FHIR 讀取重疊執行；KPI 匯總定期更新。
+    明細以 row_hash 和資料庫現有內容比對，只送出新增/變更的列，最後刪除已消失的列；
+    補抓失敗的批次鍵值加入 failed"""
+    print(f"🔄 連接至伺服器: {FHIR_SERVER_URL} (管線模式)")
+    client = FHIRClient(url=FHIR_SERVER_URL)
+    journal = RunJournal('sync_pipelined', meta={'server': FHIR_SERVER_URL, 'start_date': START_DATE})
 
-def generate_visualizations(df):
+    summary = KPISummary()
+    stop = asyncio.Event()
+    flusher = asyncio.create_task(summary.run_periodic(stop))
+    records = []
+    baseline = await fetch_stored_hashes("KPI_Detail", FHIR_SERVER_URL)
+
+    async with BatchUploader("KPI_Detail", journal=journal, baseline=baseline) as uploader:
+        params = {'date': f"ge{START_DATE}", '_count': PAGE_SIZE}
+        async for page_no, procedures in iter_pages(client, 'Procedure', params, journal):
+            pat_ids = [p.get('subject', {}).get('reference', '').split('/')[-1] for p in procedures if p.get('subject')]
+            enc_ids = [p.get('encounter', {}).get('reference', '').split('/')[-1] for p in procedures if p.get('encounter')]
+            patients = await fetch_by_ids(client, journal, 'Patient', pat_ids, tag=f"p{page_no}:", failed=failed)
+            encounters = await fetch_by_ids(client, journal, 'Encounter', enc_ids, tag=f"p{page_no}:", failed=failed)
+
+            with metrics.span('etl'):
+                page_records = list(process_records(procedures, patients, encounters, debug_rows=3 if page_no == 0 else 0))
+            metrics.add_rows('etl', len(page_records))
+            update_aggregates(cube, rolling, page_records)
+            for rec in page_records:
+                records.append(rec)
+                row = to_detail_row(rec)
+                summary.add(row)
+                await uploader.put(rec['ProcedureID'], row)
+            print(f"   ...第 {page_no + 1} 頁完成，累計 {len(records)} 筆")
+
+    stop.set()
+    await flusher
+
+    if failed:
+        # 有 Procedure 因補抓失敗沒被看到：不能當成已從 FHIR 消失而刪除
+        journal.close()
+        print(f"⚠️ {len(failed)} 個批次查詢失敗，未刪除舊資料；重新執行即可從日誌續抓 ({journal.path})")
+    elif uploader.failed_rows or summary.pending:
+        journal.close()
+        print(f"⚠️ 部分批次上傳失敗，重新執行即可從日誌續傳 ({journal.path})")
+    elif not await uploader.delete_stale():
+        journal.close()
+        print(f"⚠️ 刪除已消失的明細失敗，重新執行會再次比對並刪除 ({journal.path})")
+    else:
+        journal.finish()
+    return pd.DataFrame(records)
+
+def evict_unseen(cube, rolling, df):
+    """完整同步後，移除這個來源系統中本次沒出現的明細 (FHIR 已刪除或已超出 START_DATE 查詢期間)"""
+    seen = {row_key(FHIR_SERVER_URL, pid, INDICATOR_NAME) for pid in df.get('ProcedureID', [])}
+    prefix = f"{FHIR_SERVER_URL}|"
+    stale = [key for key in cube.rows if key.startswith(prefix) and key not in seen]
+    for key in stale:
+        cube.remove(key)
+        rolling.remove(key)
+    if stale: print(f"🧹 立方體移除 {len(stale)} 筆已刪除或超出查詢期間的明細")
+
+def print_rolling_rates(rolling):
+    """以最後一天為終點，列出全院、各醫院、各醫師的 7/30/90 日滾動比率"""
+    end_day = rolling.last_day()
+    if end_day is None: return
+    rows = []
+    for unit in rolling.units:
+        label = unit if isinstance(unit, str) else f"{unit[0]}: {unit[1]}"
+        row = {'Unit': label}
+        for days in WINDOWS:
+            num, den, rate = rolling.window(unit, end_day, days)
+            row[f'{days}d Rate %'] = round(rate, 2) if rate is not None else None
+            row[f'{days}d n'] = int(den)
+        rows.append(row)
+    print(f"\n📆 滾動視窗比率 (截至 {date.fromordinal(end_day)})")
+    print(pd.DataFrame(rows).sort_values('Unit').to_string(index=False))
+
+def generate_visualizations(df, cube, rolling):
     if df.empty:
         print("❌ 依然沒有資料。請檢查 Debug 訊息。")
         return
 
-    # 表格
-    stats = df.groupby('Doctor').agg(
-        Total=('PatientID', 'count'),
-        Numerator=('IsNumerator', 'sum')
-    ).reset_index()
-    stats['Rate %'] = (stats['Numerator'] / stats['Total'] * 100).round(2)
-    stats['Status'] = stats['Rate %'].apply(lambda x: '🔴 異常' if x > RISK_THRESHOLD else '🟢 正常')
+    # 表格 (立方體的醫院/科別/醫師格子，一次算出 Wilson 信賴區間與漏斗圖判定)
+    result = analyze_cube(cube, INDICATOR_NAME)
+    status_text = {2: '🔴 異常', 1: '🟡 警示', 0: '🟢 正常', -1: '🔵 優於平均'}
+    all_stats = pd.DataFrame({
+        'Level': result['level'],
+        'Hospital': [c['hospital'] for c in result['labels']],
+        'Department': [c['department'] for c in result['labels']],
+        'Doctor': [c['doctor'] for c in result['labels']],
+        'Total': result['denominator'].astype(int),
+        'Numerator': result['numerator'].astype(int),
+        'Rate %': (result['rate'] * 100).round(2),
+        'CI 95%': [f"{lo*100:.1f}–{hi*100:.1f}" for lo, hi in zip(result['ci_low'], result['ci_high'])],
+        'Upper 99.8%': (result['limit998_high'] * 100).round(2),
+        'Status': [status_text[f] for f in result['flag']]
+    })
+    stats = all_stats[all_stats['Level'] == 'doctor'].drop(columns=['Level', 'Hospital']).sort_values(['Department', 'Doctor'])
     
     print("\n" + "="*60)
     print("📋 [指標儀表板] 術後 48 小時死亡率統計 (依醫師)")
+    print(f"   整體比率 {result['p0']*100:.2f}%；超出漏斗圖 99.8% 上限判定為異常")
     print("="*60)
     try: print(stats.to_markdown(index=False))
     except: print(stats.to_string(index=False))
+
+    flagged = all_stats[(all_stats['Level'] != 'doctor') & (all_stats['Status'] != '🟢 正常')]
+    if not flagged.empty:
+        print("\n🏥 醫院 / 科別層級統計警示:")
+        print(flagged.drop(columns=['Doctor']).to_string(index=False))
+
+    # SPC p-chart：各醫師每月是否超出自己的 3-sigma 管制上限
+    labels, months, num, den = cube_matrix(cube, 'doctor', INDICATOR_NAME)
+    if labels:
+        _, _, ucl = p_chart_limits(num, den)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out = (den > 0) & (num / den > ucl)
+        for i, j in zip(*np.nonzero(out)):
+            print(f"   ⚠️ p-chart 失控: {labels[i]['doctor']} {months[j]} ({int(num[i, j])}/{int(den[i, j])})")
     
-    # 圖表
-    trend = df.groupby('Month')['IsNumerator'].mean().reset_index()
-    plt.figure(figsize=(10, 5))
-    plt.plot(trend['Month'], trend['IsNumerator']*100, '-o', color='red', label='Mortality Rate')
-    plt.axhline(y=RISK_THRESHOLD, color='gray', linestyle='--')
-    plt.title("48h Mortality Rate Trend")
-    plt.ylabel("Rate (%)")
-    plt.legend()
-    plt.grid(True, alpha=0.3)
-    print("\n📈 正在開啟趨勢圖...")
-    plt.show()
+    print_rolling_rates(rolling)
+
+    # 圖表：無顯示器 (或設定 KPIM_RENDER_DIR) 時，以行程池批次輸出全院、各醫院、科別、醫師的
+    # 趨勢圖與各層級漏斗圖；否則開視窗顯示全院趨勢 (matplotlib 到這裡才載入)
+    if headless():
+        render_batch(kpi_jobs(cube, INDICATOR_NAME, RISK_THRESHOLD, title="48h Mortality"))
+    else:
+        print("\n📈 正在開啟趨勢圖...")
+        show(trend_job('trend_all', "48h Mortality Rate Trend", cube.trend(INDICATOR_NAME), RISK_THRESHOLD))
     
     # 明細
     bad_cases = df[df['IsNumerator'] == 1]
@@ -184,11 +369,30 @@ def generate_visualizations(df):
         print(bad_cases[cols].to_string(index=False))
 
 async def main():
-    procs, pats, encs = await fetch_surgery_data()
-    if not procs: return
-    
-    df = process_data(procs, pats, encs)
-    generate_visualizations(df)
+    with metrics.run('Get_KPIM_DATA'):
+        load_env()
+        # 重播時從空白開始且不存檔，不動正式的立方體與滾動視窗
+        replay = bool(http_capture.REPLAY)
+        cube = KPICube() if replay else KPICube.load()
+        rolling = RollingRates() if replay else RollingRates.load()
+        failed = []
+        if PIPELINE_UPLOAD:
+            df = await sync_pipelined(cube, rolling, failed)
+        else:
+            procs, pats, encs = await fetch_surgery_data(failed)
+            df = process_data(procs, pats, encs)
+            with metrics.span('aggregate'):
+                update_aggregates(cube, rolling, df.to_dict('records'))
+            metrics.add_rows('aggregate', len(df))
+        if not failed:
+            evict_unseen(cube, rolling, df)
+        if not replay:
+            cube.save()
+            rolling.save()
+        if await cube.upload() and not replay:
+            cube.save()   # 已上傳的格子不再標記為變動
+        with metrics.span('report'):
+            generate_visualizations(df, cube, rolling)
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    run_profile.run('Get_KPIM_DATA', main)
\ No newline at end of file
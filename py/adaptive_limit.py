@@ -0,0 +1,163 @@
+import asyncio
+import os
+import time
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import run_metrics as metrics
+
+# ==========================================
+# 自適應並行上限 (AIMD，所有 FHIR 請求共用)
+# ==========================================
+# 每台伺服器 (host) 一個 AdaptiveLimiter，FHIRClient 的每個請求先取得名額才送出：
+#   - 延遲平穩且名額用滿時，每送完「一輪」(約 limit 個請求) 上限 +1 (加法增加)
+#   - 平滑延遲超過無負載延遲的 LATENCY_TOLERANCE 倍時，上限 × LATENCY_BACKOFF
+#   - 429 / 5xx / 連線錯誤時，上限 × ERROR_BACKOFF；有 Retry-After 就暫停發出新請求到指定時間
+# 同一波壅塞中許多請求會同時失敗，所以兩次調降至少間隔一個平滑延遲。
+# 呼叫端把工作全部丟進 asyncio.gather (或大量工作交給 map_bounded 的固定工作者)，實際同時請求數由這裡決定。
+# 目前上限寫入量測 (concurrency_limit / concurrency_limit_peak，依 host 標籤)。
+INITIAL_LIMIT = int(os.environ.get("KPIM_CONCURRENCY_INITIAL", "8"))
+MIN_LIMIT = 1
+MAX_LIMIT = int(os.environ.get("KPIM_CONCURRENCY_MAX", "64"))
+LATENCY_TOLERANCE = 2.0
+LATENCY_BACKOFF = 0.9
+ERROR_BACKOFF = 0.5
+SMOOTHING = 0.2          # 延遲 EWMA 的權重
+BASELINE_DRIFT = 0.01    # 無負載延遲每次往平滑延遲靠近的比例 (伺服器本身變慢後能重新適應)
+MAX_RETRY_AFTER = 60.0
+
+
+def parse_retry_after(value):
+    """Retry-After 標頭 (秒數或 HTTP 日期) → 秒數；無法解析時回傳 None"""
+    if not value: return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveLimiter:
+
+    def __init__(self, name, initial=INITIAL_LIMIT, min_limit=MIN_LIMIT, max_limit=MAX_LIMIT):
+        self.name = name
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.in_flight = 0
+        self.peak = int(initial)
+        self.latency = None       # 平滑延遲 (EWMA)
+        self.baseline = None      # 無負載延遲估計
+        self.paused_until = 0.0
+        self._last_backoff = 0.0
+        self._waiters = deque()
+
+    def _open(self):
+        return self.in_flight < int(self.limit) and time.monotonic() >= self.paused_until
+
+    def _wake(self):
+        # 有空名額就依序交給等待中的請求 (名額在這裡就先算進 in_flight)
+        while self._waiters and self._open():
+            fut = self._waiters.popleft()
+            if not fut.done():
+                self.in_flight += 1
+                fut.set_result(None)
+
+    async def acquire(self):
+        if not self._waiters and self._open():
+            self.in_flight += 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.in_flight -= 1   # 已分到名額才被取消，歸還
+                self._wake()
+            else:
+                self._waiters.remove(fut)
+            raise
+
+    def release(self, seconds, status=None, retry_after=None):
+        """請求結束：依延遲與狀態碼調整上限 (status=None 表示連線錯誤)"""
+        saturated = self.in_flight >= int(self.limit)
+        self.in_flight -= 1
+        if status is None or status == 429 or status >= 500:
+            self._backoff(ERROR_BACKOFF, 'error' if status is None else str(status))
+            if retry_after:
+                delay = min(retry_after, MAX_RETRY_AFTER)
+                self.paused_until = max(self.paused_until, time.monotonic() + delay)
+                asyncio.get_running_loop().call_later(delay, self._wake)
+        else:
+            self.latency = seconds if self.latency is None else self.latency + SMOOTHING * (seconds - self.latency)
+            if self.baseline is None:
+                self.baseline = seconds
+            else:
+                self.baseline = min(self.baseline, self.latency)
+                self.baseline += BASELINE_DRIFT * (self.latency - self.baseline)
+            if self.latency > self.baseline * LATENCY_TOLERANCE:
+                self._backoff(LATENCY_BACKOFF, 'latency')
+            elif saturated and self.limit < self.max_limit:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self.peak = max(self.peak, int(self.limit))
+        metrics.set_gauge('concurrency_limit', int(self.limit), host=self.name)
+        metrics.set_gauge('concurrency_limit_peak', self.peak, host=self.name)
+        self._wake()
+
+    def _backoff(self, factor, reason):
+        now = time.monotonic()
+        if now - self._last_backoff < (self.latency or 0): return
+        self._last_backoff = now
+        self.limit = max(self.min_limit, self.limit * factor)
+        metrics.inc('concurrency_backoff', host=self.name, reason=reason)
+
+
+_limiters = {}
+
+
+def limiter(name):
+    """取得 (必要時建立) 某台伺服器共用的 AdaptiveLimiter"""
+    if name not in _limiters:
+        _limiters[name] = AdaptiveLimiter(name)
+    return _limiters[name]
+
+
+def reset():
+    """捨棄所有 host 學到的上限與延遲 (效能測試每次量測從初始狀態開始)"""
+    _limiters.clear()
+
+
+async def map_bounded(fn, items, workers=MAX_LIMIT):
+    """以 workers 個工作者依序取出 items 執行 fn(item)，依完成先後產出結果：
+    async for result in map_bounded(fn, range(n)): ...
+    同一時間最多 workers 個協程 (不為每個項目預先建立任務)；任一項目失敗時停止其他工作者並拋出該例外"""
+    items = iter(items)
+    results = asyncio.Queue()
+    done = object()
+
+    async def worker():
+        try:
+            for item in items:
+                results.put_nowait((await fn(item), None))
+        except Exception as e:
+            results.put_nowait((None, e))
+        results.put_nowait(done)
+
+    tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+    try:
+        running = len(tasks)
+        while running:
+            entry = await results.get()
+            if entry is done:
+                running -= 1
+                continue
+            value, error = entry
+            if error is not None: raise error
+            yield value
+    finally:
+        for task in tasks: task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
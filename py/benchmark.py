@@ -0,0 +1,179 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+import Get_KPIM_DATA as G
+import adaptive_limit
+import http_session
+import render_charts
+from kpi_cube import KPICube, CUBE_TABLE
+from rolling_rates import RollingRates
+from supabase_upload import BatchUploader, upsert_supabase
+from mock_fhir_server import MockFHIRServer
+
+# ==========================================
+# 端到端效能測試 (本機模擬 FHIR 伺服器)
+# ==========================================
+# 用法：python benchmark.py --sizes 1000 10000 100000 [--page-size 200] [--latency-ms 5]
+# 對每個資料量啟動 mock_fhir_server，依序量測：
+#   fetch_surgery_data        分頁撈 Procedure + 以 _id 補抓 Patient / Encounter
+#   process_data              ETL (process_records → DataFrame)
+#   aggregate                 update_aggregates (KPI 立方體 + 滾動視窗)
+#   generate_visualizations   統計表 + 無頭模式批次輸出圖表
+#   upload.KPI_Detail         BatchUploader 上傳明細 (Supabase REST 替身)
+#   upload.KPI_Cube           KPI 立方體的匯總列上傳
+# 每項重複 --repeat 次取最短時間，印出結果表並寫入 --output (JSON)。
+# 與 BASELINE_PATH 比較，慢於基準 (1 + TOLERANCE) 倍即標示退化並以結束碼 1 結束；
+# --save-baseline 以本次結果覆寫基準。基準與機器有關，不納入版本控制。
+# 注意：100 萬筆時三種資源全部留在記憶體中，需數 GB。
+BASELINE_PATH = os.environ.get("KPIM_BENCH_BASELINE",
+                               os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json"))
+TOLERANCE = 0.25
+NOISE_SECONDS = 0.02   # 絕對差距小於此值不算退化 (很短的階段容易受雜訊影響)
+DEFAULT_SIZES = (1000, 10000)
+
+
+def run(coro):
+    """每次量測各自一個事件迴圈，結束時關閉共用連線池"""
+    return asyncio.run(http_session.closing(coro))
+
+
+def measure(results, name, size, repeat, fn, rows=None):
+    """執行 fn() repeat 次 (吞掉輸出)，記錄最短秒數；回傳最後一次的結果
+    每次執行前重設自適應並行上限，避免沿用前一次 (或前一個資料量) 學到的上限與延遲"""
+    times = []
+    out = None
+    for _ in range(repeat):
+        adaptive_limit.reset()
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = time.perf_counter()
+            out = fn()
+            times.append(time.perf_counter() - started)
+    rows = size if rows is None else rows
+    best = min(times)
+    results.append({'benchmark': name, 'size': size, 'rows': rows, 'seconds': round(best, 4),
+                    'rows_per_second': round(rows / best, 1) if best > 0 else None})
+    print(f"   {name:<24} {best:9.3f} 秒  ({rows} 筆)", file=sys.__stdout__)
+    return out
+
+
+def build_aggregates(df):
+    cube, rolling = KPICube(), RollingRates()
+    G.update_aggregates(cube, rolling, df.to_dict('records'))
+    return cube, rolling
+
+
+async def upload_details(df):
+    async with BatchUploader("KPI_Detail") as uploader:
+        for rec in df.to_dict('records'):
+            await uploader.put(rec['ProcedureID'], G.to_detail_row(rec))
+    return uploader.uploaded_rows
+
+
+def bench_size(server, size, repeat):
+    results = []
+    print(f"\n⏱️ 資料量 {size} (單頁 {G.PAGE_SIZE} 筆，延遲 {server.latency * 1000:.0f} ms)")
+    procs, pats, encs = measure(results, 'fetch_surgery_data', size, repeat,
+                                lambda: run(G.fetch_surgery_data()))
+    if len(procs) != size:
+        raise RuntimeError(f"撈回 {len(procs)} 筆 Procedure，預期 {size} 筆")
+    df = measure(results, 'process_data', size, repeat, lambda: G.process_data(procs, pats, encs))
+    cube, rolling = measure(results, 'aggregate', len(df), repeat, lambda: build_aggregates(df))
+    measure(results, 'generate_visualizations', len(df), repeat,
+            lambda: G.generate_visualizations(df, cube, rolling))
+    measure(results, 'upload.KPI_Detail', len(df), repeat, lambda: run(upload_details(df)))
+    kpi_rows = cube.dirty_rows()   # 不用 cube.upload()：它成功後會清空變動標記，重複量測就沒東西可傳
+    measure(results, f"upload.{CUBE_TABLE}", len(df), repeat,
+            lambda: run(upsert_supabase(CUBE_TABLE, kpi_rows, ("hospital", "department", "doctor", "indicator_name", "month"))),
+            rows=len(kpi_rows))
+    return results
+
+
+# ---------- 基準比較 ----------
+def load_baseline(path, config):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print(f"\nℹ️ 尚無基準 ({path})，可加 --save-baseline 建立")
+        return {}
+    if baseline.get('config') != config:
+        print(f"\n⚠️ 基準的設定 {baseline.get('config')} 與本次 {config} 不同，不做比較")
+        return {}
+    return {f"{r['benchmark']}@{r['size']}": r['seconds'] for r in baseline['results']}
+
+
+def print_table(results, baseline):
+    """印出結果表，回傳退化的項目"""
+    regressions = []
+    print(f"\n{'項目':<24} {'筆數':>9} {'秒數':>9} {'筆/秒':>11} {'基準秒數':>9} {'變化':>8}")
+    for r in results:
+        base = baseline.get(f"{r['benchmark']}@{r['size']}")
+        change, flag = '', ''
+        if base:
+            ratio = r['seconds'] / base
+            change = f"{(ratio - 1) * 100:+.0f}%"
+            if ratio > 1 + TOLERANCE and r['seconds'] - base > NOISE_SECONDS:
+                flag = ' 🔴 退化'
+                regressions.append(r)
+        rate = f"{r['rows_per_second']:.0f}" if r['rows_per_second'] else '-'
+        print(f"{r['benchmark']:<24} {r['size']:>9} {r['seconds']:>9.3f} {rate:>11} "
+              f"{base if base else '-':>9} {change:>8}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="KPIM 端到端效能測試 (本機模擬 FHIR 伺服器)")
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES))
+    parser.add_argument('--page-size', type=int, default=G.PAGE_SIZE)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help="每個請求注入的伺服器延遲")
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--output', default=f"benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args()
+
+    config = {'page_size': args.page_size, 'latency_ms': args.latency_ms}
+    output = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.baseline)
+    results = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="kpim_bench_") as workdir:
+        # 日誌、立方體檔與圖表都寫到暫存目錄，不影響正式資料
+        os.chdir(workdir)
+        os.environ["NEXT_PUBLIC_SUPABASE_ANON_KEY"] = "benchmark"
+        G.PAGE_SIZE = args.page_size
+        render_charts.RENDER_DIR = os.path.join(workdir, "charts")
+        try:
+            for size in args.sizes:
+                with MockFHIRServer(total=size, latency=args.latency_ms / 1000) as server:
+                    G.FHIR_SERVER_URL = server.fhir_url
+                    os.environ["NEXT_PUBLIC_SUPABASE_URL"] = server.base_url
+                    results += bench_size(server, size, args.repeat)
+        finally:
+            os.chdir(cwd)
+
+    regressions = print_table(results, load_baseline(baseline_path, config))
+    report = {'started': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+              'cpus': os.cpu_count(), 'config': config, 'results': results}
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n💾 結果已寫入 {output}")
+    if args.save_baseline:
+        with open(baseline_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"📌 已更新基準 {baseline_path}")
+    if regressions:
+        print(f"🔴 {len(regressions)} 項慢於基準 {TOLERANCE * 100:.0f}% 以上")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import asyncio
+import json
+import os
+import time
+from urllib.parse import urlsplit
+import aiohttp
+from fhirpy import AsyncFHIRClient
+from fhirpy.base.exceptions import (
+    AuthorizationError, ForbiddenError, MultipleResourcesFound, OperationOutcome, ResourceNotFound
+)
+from fhirpy.base.utils import AttrDict
+import run_metrics as metrics
+from adaptive_limit import limiter, parse_retry_after, MAX_RETRY_AFTER
+import http_session
+import http_capture
+
+# ==========================================
+# 共用 FHIR client
+# ==========================================
+# 繼承 fhirpy 的 AsyncFHIRClient，只改寫底層的 _do_request (所有 search / save / execute
+# 最後都會經過這裡)，在同一處記錄每個請求的資源類型、狀態碼、位元組與延遲。
+# 錯誤處理與 fhirpy 原本相同 (401/403/404/410/412 及 OperationOutcome)。
+# 每個請求先向該 host 共用的自適應並行上限 (adaptive_limit) 取得名額；
+# 429 一律重試，502/503/504 與連線錯誤只對 GET 與 PUT (帶明確 id，重送結果相同) 重試 (POST 可能已被伺服器處理)，
+# 等待時間依 Retry-After，沒有時指數退避。
+# 連線走 http_session 的共用連線池；Authorization (參數或 KPIM_FHIR_AUTHORIZATION) 也登記在那裡，
+# fhirpy 的 aiohttp_config (timeout、ssl、proxy…) 照樣套用到每個請求。
+# 設定 KPIM_CAPTURE_DIR 時錄下每個回應，設定 KPIM_REPLAY 時改由錄製檔回應、不連網路 (http_capture)。
+MAX_RETRIES = 3
+RETRY_BACKOFF_SECONDS = 1.0
+RETRY_STATUSES = (502, 503, 504)
+
+
+class FHIRClient(AsyncFHIRClient):
+
+    def __init__(self, url, authorization=None, **kwargs):
+        super().__init__(url, **kwargs)
+        authorization = authorization or os.environ.get("KPIM_FHIR_AUTHORIZATION")
+        if authorization: http_session.configure_auth(url, {'Authorization': authorization})
+
+    def _resource_label(self, url):
+        """請求對應的資源類型 (Procedure、Patient…)；對 base 的 POST (batch Bundle) 為 'batch'"""
+        base = urlsplit(self.url).path.rstrip('/')
+        path = urlsplit(url).path
+        if path.startswith(base): path = path[len(base):]
+        return path.strip('/').split('/')[0] or 'batch'
+
+    async def _send(self, method, url, body, headers):
+        """送出請求，回傳 (狀態碼, 回應標頭, 回應內容 bytes)"""
+        player = http_capture.player()
+        if player: return player.replay(method, url, body)
+        status, resp_headers, content = await http_session.request(method, url, body, headers, **self.aiohttp_config)
+        recorder = http_capture.recorder()
+        if recorder: recorder.record(method, url, body, status, resp_headers, content)
+        return status, resp_headers, content
+
+    async def _request(self, method, url, body, headers):
+        """經由並行上限送出並處理重試，回傳 (狀態碼, 回應內容 bytes)"""
+        gate = limiter(urlsplit(url).netloc)
+        resource = self._resource_label(url)
+        idempotent = method.upper() in ('GET', 'PUT')
+        for attempt in range(MAX_RETRIES + 1):
+            await gate.acquire()
+            started = time.perf_counter()
+            status, retry_after, content = None, None, b''
+            try:
+                status, resp_headers, content = await self._send(method, url, body, headers)
+                retry_after = parse_retry_after(resp_headers.get('Retry-After'))
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if not idempotent or attempt == MAX_RETRIES: raise
+            finally:
+                seconds = time.perf_counter() - started
+                gate.release(seconds, status, retry_after)
+                metrics.http_request('fhir', method, resource, status or 'error', seconds,
+                                     len(body or b''), len(content))
+
+            retryable = status is None or status == 429 or (idempotent and status in RETRY_STATUSES)
+            if not retryable or attempt == MAX_RETRIES:
+                return status, content
+            metrics.inc('http_retries', service='fhir', status=status or 'error')
+            await asyncio.sleep(min(retry_after, MAX_RETRY_AFTER) if retry_after is not None
+                                else RETRY_BACKOFF_SECONDS * 2 ** attempt)
+
+    async def _do_request(self, method, path, data=None, params=None, extra_headers=None, *, returning_status=False):
+        headers = self._build_request_headers()
+        if extra_headers:
+            headers = {**headers, **extra_headers}
+        body = None
+        if data is not None:
+            body = json.dumps(data).encode('utf-8')
+            headers = {**headers, 'Content-Type': 'application/json'}
+
+        url = self._build_request_url(path, params)
+        status, content = await self._request(method, url, body, headers)
+        raw_data = content.decode('utf-8')
+
+        if 200 <= status < 300:
+            r_data = json.loads(raw_data, object_hook=AttrDict) if raw_data else None
+            return (r_data, status) if returning_status else r_data
+        if status == 401: raise AuthorizationError(raw_data)
+        if status == 403: raise ForbiddenError(raw_data)
+        if status == 304: return (None, status) if returning_status else None
+        if status in (404, 410): raise ResourceNotFound(raw_data)
+        if status == 412: raise MultipleResourcesFound(raw_data)
+        try:
+            parsed_data = json.loads(raw_data)
+            if parsed_data["resourceType"] == "OperationOutcome":
+                raise OperationOutcome(resource=parsed_data)
+            raise OperationOutcome(reason=raw_data)
+        except (KeyError, TypeError, json.JSONDecodeError) as exc:
+            raise OperationOutcome(reason=raw_data) from exc
@@ -0,0 +1,50 @@
+# ==========================================
+# FHIR 搜尋分頁
+# ==========================================
+# 直接以 client.execute 取得原始 Bundle (不經 fhirpy 資源包裝)，沿 next 連結逐頁抓取。
+# 每頁記錄在 fetch.<資源類型> span，並計入該階段筆數。
+import run_metrics as metrics
+
+def bundle_resources(bundle):
+    return [e['resource'] for e in (bundle or {}).get('entry', []) if 'resource' in e]
+
+def next_link(bundle):
+    for link in (bundle or {}).get('link', []):
+        if link.get('relation') == 'next':
+            return link.get('url')
+    return None
+
+async def iter_pages(client, resource_type, params, journal=None):
+    """逐頁產出 (頁碼, 資源列表)；有日誌時每頁都記錄，續跑時先還原已抓的頁面，
+    再由最後一頁的 next 連結接著抓"""
+    url = None
+    pages = journal.entries(resource_type) if journal else {}
+    for page_no, page in enumerate(pages.values()):
+        yield page_no, page['entries']
+        url = page['next']
+        if not url: return
+
+    page_no = len(pages)
+    if page_no:
+        print(f"   ♻️ 已從日誌還原 {page_no} 頁，繼續抓取")
+
+    while True:
+        with metrics.span(f"fetch.{resource_type}"):
+            if url:
+                bundle = await client.execute(url, method='get')
+            else:
+                bundle = await client.execute(resource_type, method='get', params=params)
+        entries = bundle_resources(bundle)
+        metrics.add_rows(f"fetch.{resource_type}", len(entries))
+        url = next_link(bundle)
+        if journal: journal.record(resource_type, page_no, {'entries': entries, 'next': url})
+        yield page_no, entries
+        page_no += 1
+        if not url: return
+
+async def fetch_pages(client, resource_type, params, journal=None):
+    """抓取搜尋結果的所有頁面"""
+    resources = []
+    async for _, entries in iter_pages(client, resource_type, params, journal):
+        resources.extend(entries)
+    return resources
@@ -1,12 +1,11 @@
-import asyncio
 import random
 import time
 from datetime import datetime, timedelta
-from fhirpy import AsyncFHIRClient
-import urllib3
-
-# 忽略 SSL 警告
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+from run_journal import RunJournal
+from fhir_client import FHIRClient
+from adaptive_limit import map_bounded
+import run_metrics as metrics
+import run_profile
 
 # ==========================================
 # 設定參數
@@ -68,10 +67,10 @@ def get_long_id():
     rand = str(random.randint(1000, 9999))
     return f"{prefix}{ts}{rand}"
 
-async def create_infrastructure(client):
-    """建立多醫院架構：醫院 -> 科別 -> 醫師"""
-    print("🏥 正在建立三家醫院的組織架構...")
+def plan_infrastructure():
+    """規劃多醫院架構：醫院 -> 科別 -> 醫師 (只產生 ID 與內容，尚未寫入)"""
     infra = {}
+    resources = [] # (resource_type, 內容) 依寫入順序排列
     
     for hosp in HOSPITALS:
         h_code = hosp['code']
@@ -83,8 +82,7 @@ async def create_infrastructure(client):
             dept_org_id = get_long_id()
             full_dept_name = f"【{hosp['name']}】{d_info['name']}"
             
-            org = client.resource('Organization', id=dept_org_id, name=full_dept_name, active=True)
-            await org.save()
+            resources.append(('Organization', {'id': dept_org_id, 'name': full_dept_name, 'active': True}))
             
             # 2. 建立該科別的專屬醫師
             dept_docs = []
@@ -93,13 +91,11 @@ async def create_infrastructure(client):
                 # 醫師名字加上醫院縮寫，方便識別 (ex: 劉醫師(TP))
                 full_doc_name = f"{surname}醫師 ({hosp['name'][:2]})"
                 
-                prac = client.resource(
-                    'Practitioner',
-                    id=doc_id,
-                    name=[{'text': full_doc_name}],
-                    active=True
-                )
-                await prac.save()
+                resources.append(('Practitioner', {
+                    'id': doc_id,
+                    'name': [{'text': full_doc_name}],
+                    'active': True
+                }))
                 dept_docs.append(doc_id)
             
             infra[h_code]['depts'].append({
@@ -109,7 +105,23 @@ async def create_infrastructure(client):
                 'procs': d_info['procs']
             })
             
-    return infra
+    return infra, resources
+
+async def create_infrastructure(client, journal):
+    """建立多醫院架構 (先記錄規劃再寫入，中斷後以相同 ID 重寫)"""
+    print("🏥 正在建立三家醫院的組織架構...")
+    plan = journal.get('infra', 'plan')
+    if plan is None:
+        infra, resources = plan_infrastructure()
+        plan = {'infra': infra, 'resources': resources}
+        journal.record('infra', 'plan', plan)
+
+    if not journal.has('infra', 'done'):
+        for resource_type, body in plan['resources']:
+            await client.resource(resource_type, **body).save()
+        journal.record('infra', 'done')
+            
+    return plan['infra']
 
 def calculate_risk(day_index, hospital_factor):
     """風險計算：基礎風險 * 醫院係數 + 波動"""
@@ -122,7 +134,8 @@ def calculate_risk(day_index, hospital_factor):
     noise = random.uniform(-0.005, 0.005)
     return max(0, (base * hospital_factor) + fluctuation + noise)
 
-async def generate_case(client, infra, day_index, today):
+def plan_case(infra, day_index, today):
+    """規劃單一案例：決定所有隨機值與 ID，回傳待寫入的資源"""
     # 1. 隨機選醫院 (權重均等)
     hosp_code = random.choice(list(infra.keys()))
     hospital_data = infra[hosp_code]
@@ -154,76 +167,87 @@ async def generate_case(client, infra, day_index, today):
     else:
         period_end = op_end + timedelta(days=random.randint(3, 8))
     
-    # 4. 寫入資源 (一案一人，ID 唯一)
+    # 4. 資源內容 (一案一人，ID 唯一)
     pat_id = get_long_id()
     gender = random.choice(['male', 'female'])
     lname, fname = generate_chinese_name(gender)
     
     # Patient
-    pat = client.resource('Patient', id=pat_id, gender=gender, name=[{'family': lname, 'given': [fname]}])
+    pat = {'id': pat_id, 'gender': gender, 'name': [{'family': lname, 'given': [fname]}]}
     if death_date: pat['deceasedDateTime'] = death_date.strftime('%Y-%m-%dT%H:%M:%S+00:00')
-    await pat.save()
     
     # Encounter (綁定到該醫院的科別 Organization)
     enc_id = get_long_id()
-    enc = client.resource(
-        'Encounter',
-        id=enc_id,
-        status='finished',
-        class_={'system': 'http://terminology.hl7.org/CodeSystem/v3-ActCode', 'code': 'IMP'},
-        subject={'reference': f"Patient/{pat_id}"},
-        period={'start': (op_start-timedelta(days=1)).strftime('%Y-%m-%dT%H:%M:%S+00:00'), 
-                'end': period_end.strftime('%Y-%m-%dT%H:%M:%S+00:00')},
-        hospitalization={'dischargeDisposition': {'coding': [{'code': disposition}]}},
-        serviceProvider={
+    enc = {
+        'id': enc_id,
+        'status': 'finished',
+        'class_': {'system': 'http://terminology.hl7.org/CodeSystem/v3-ActCode', 'code': 'IMP'},
+        'subject': {'reference': f"Patient/{pat_id}"},
+        'period': {'start': (op_start-timedelta(days=1)).strftime('%Y-%m-%dT%H:%M:%S+00:00'), 
+                   'end': period_end.strftime('%Y-%m-%dT%H:%M:%S+00:00')},
+        'hospitalization': {'dischargeDisposition': {'coding': [{'code': disposition}]}},
+        'serviceProvider': {
             'reference': f"Organization/{dept['org_id']}",
             'display': dept['org_name'] # 直接存入名稱方便顯示
         }
-    )
-    await enc.save()
+    }
     
     # Procedure
     proc_id = get_long_id()
-    proc = client.resource(
-        'Procedure',
-        id=proc_id,
-        status='completed',
-        subject={'reference': f"Patient/{pat_id}"},
-        encounter={'reference': f"Encounter/{enc_id}"},
-        performedPeriod={'start': op_start.strftime('%Y-%m-%dT%H:%M:%S+00:00'), 
-                         'end': op_end.strftime('%Y-%m-%dT%H:%M:%S+00:00')},
-        code={'coding': [{'system': 'http://snomed.info/sct', 'code': proc_info['code'], 'display': proc_info['display']}]},
-        performer=[{'actor': {'reference': f"Practitioner/{doc_id}"}}]
-    )
-    await proc.save()
+    proc = {
+        'id': proc_id,
+        'status': 'completed',
+        'subject': {'reference': f"Patient/{pat_id}"},
+        'encounter': {'reference': f"Encounter/{enc_id}"},
+        'performedPeriod': {'start': op_start.strftime('%Y-%m-%dT%H:%M:%S+00:00'), 
+                            'end': op_end.strftime('%Y-%m-%dT%H:%M:%S+00:00')},
+        'code': {'coding': [{'system': 'http://snomed.info/sct', 'code': proc_info['code'], 'display': proc_info['display']}]},
+        'performer': [{'actor': {'reference': f"Practitioner/{doc_id}"}}]
+    }
     
-    return is_bad
+    return {'resources': [('Patient', pat), ('Encounter', enc), ('Procedure', proc)], 'is_bad': is_bad}
+
+async def generate_case(client, infra, journal, case_no, today):
+    # 已完成的案例直接略過；已規劃未完成的沿用原 ID 重寫 (PUT 具冪等性)
+    plan = journal.get('case', case_no)
+    if journal.has('case_done', case_no):
+        return plan['is_bad']
+    if plan is None:
+        plan = plan_case(infra, random.randint(0, DAYS_BACK), today)
+        journal.record('case', case_no, plan)
+
+    with metrics.span('generate.case'):
+        for resource_type, body in plan['resources']:
+            await client.resource(resource_type, **body).save()
+    metrics.add_rows('generate.case', 1)
+
+    journal.record('case_done', case_no)
+    return plan['is_bad']
 
 async def main():
-    print(f"🚀 開始生成多醫院擬真數據 (目標: {TOTAL_CASES} 筆)...")
-    client = AsyncFHIRClient(url=FHIR_SERVER_URL)
+    with metrics.run('generate_surgery_data'):
+        print(f"🚀 開始生成多醫院擬真數據 (目標: {TOTAL_CASES} 筆)...")
+        client = FHIRClient(url=FHIR_SERVER_URL)
+        journal = RunJournal('generate_surgery_data', meta={'server': FHIR_SERVER_URL, 'total_cases': TOTAL_CASES})
     
-    infra = await create_infrastructure(client)
-    print("✅ 三家醫院與科別架構建立完成")
+        with metrics.span('generate.infrastructure'):
+            infra = await create_infrastructure(client, journal)
+        print("✅ 三家醫院與科別架構建立完成")
     
-    tasks = []
-    today = datetime.now()
-    bad_count = 0
+        today = datetime.now()
+        bad_count = 0
     
-    print("⏳ 正在寫入數據 (含姓名、醫院標籤、風險波動)...")
+        print("⏳ 正在寫入數據 (含姓名、醫院標籤、風險波動)...")
     
-    for i in range(TOTAL_CASES):
-        day_index = random.randint(0, DAYS_BACK)
-        tasks.append(generate_case(client, infra, day_index, today))
-        
-    chunk_size = 20
-    for i in range(0, len(tasks), chunk_size):
-        chunk = tasks[i:i+chunk_size]
-        results = await asyncio.gather(*chunk)
-        bad_count += sum(results)
-        print(f"\r   ...已完成 {min(i+chunk_size, TOTAL_CASES)}/{TOTAL_CASES}", end="", flush=True)
+        cases = map_bounded(lambda case_no: generate_case(client, infra, journal, case_no, today), range(TOTAL_CASES))
+        done = 0
+        async for bad in cases:
+            done += 1
+            bad_count += bad
+            print(f"\r   ...已完成 {done}/{TOTAL_CASES}", end="", flush=True)
         
-    print(f"\n🎉 完成！共產生 {TOTAL_CASES} 筆，異常案例 {bad_count} 筆")
+        journal.finish()
+        print(f"\n🎉 完成！共產生 {TOTAL_CASES} 筆，異常案例 {bad_count} 筆")
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    run_profile.run('generate_surgery_data', main)
\ No newline at end of file
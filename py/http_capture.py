@@ -0,0 +1,162 @@
+import atexit
+import glob
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+import run_metrics as metrics
+
+# ==========================================
+# FHIR 回應錄製 / 重播
+# ==========================================
+# 錄製：設定 KPIM_CAPTURE_DIR，FHIRClient 收到的每個回應都寫入該目錄：
+#   objects/<sha 前兩碼>/<sha256>.gz   回應內容 (gzip)，以內容雜湊命名，相同內容只存一份 (跨次執行共用)
+#   runs/<程式>_<時間>.jsonl           本次執行的索引：每行一個請求 (方法、網址、狀態碼、標頭、內容雜湊)
+# 重播：設定 KPIM_REPLAY=<錄製目錄 (取最新一次) 或 runs/*.jsonl>，FHIRClient 不連網路，
+# 直接從索引回應 (同一請求錄到多次時取最後一次)；找不到的請求會拋出 ReplayMiss。
+# 比對請求時忽略 REPLAY_IGNORE_PARAMS (預設 date：START_DATE 每天變動，隔天重播網址就不同)。
+# 重播時不動正式狀態：Supabase 讀寫一律略過，執行日誌改寫到 scratch_dir() (結束時刪除)，
+# KPI 立方體與滾動視窗從空白開始且不存檔。
+# 列出錄製內容：python http_capture.py <錄製目錄>
+CAPTURE_DIR = os.environ.get("KPIM_CAPTURE_DIR")
+REPLAY = os.environ.get("KPIM_REPLAY")
+REPLAY_IGNORE_PARAMS = tuple(p for p in os.environ.get("KPIM_REPLAY_IGNORE_PARAMS", "date").split(',') if p)
+KEPT_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Location', 'Retry-After')
+COMPRESS_LEVEL = 6
+MAX_MISS_LOG = 10
+
+
+class ReplayMiss(LookupError):
+    """重播時錄製檔中沒有這個請求"""
+
+
+def request_key(method, url, body=None):
+    """請求的比對鍵：方法 + 網址 (查詢參數排序、去掉忽略的參數) + 請求內容雜湊"""
+    parts = urlsplit(url)
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in REPLAY_IGNORE_PARAMS)
+    key = f"{method.upper()} {urlunsplit(parts._replace(query=urlencode(query), fragment=''))}"
+    if body: key += f" #{hashlib.sha256(body).hexdigest()[:16]}"
+    return key
+
+
+def _object_path(root, digest):
+    return os.path.join(root, 'objects', digest[:2], f"{digest}.gz")
+
+
+class Recorder:
+
+    def __init__(self, root, name=None):
+        self.root = root
+        name = name or os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'run'
+        os.makedirs(os.path.join(root, 'runs'), exist_ok=True)
+        self.path = os.path.join(root, 'runs', f"{name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.getpid()}.jsonl")
+        self._index = open(self.path, 'a', encoding='utf-8')
+        self.count = 0
+        print(f"📼 錄製 FHIR 回應: {self.path}")
+
+    def record(self, method, url, body, status, headers, content):
+        digest = hashlib.sha256(content).hexdigest()
+        path = _object_path(self.root, digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(gzip.compress(content, COMPRESS_LEVEL, mtime=0))
+            os.replace(tmp, path)
+        entry = {'key': request_key(method, url, body), 'method': method.upper(), 'url': url, 'status': status,
+                 'headers': {h: headers[h] for h in KEPT_HEADERS if h in headers},
+                 'body': digest, 'size': len(content), 'recorded': round(time.time(), 3)}
+        self._index.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._index.flush()   # 中途中斷也保留已錄到的部分
+        self.count += 1
+        metrics.inc('capture_responses')
+
+
+class Player:
+
+    def __init__(self, target):
+        if os.path.isdir(target):
+            runs = sorted(glob.glob(os.path.join(target, 'runs', '*.jsonl')), key=os.path.getmtime)
+            if not runs: raise FileNotFoundError(f"{target} 中沒有錄製檔")
+            self.root, self.path = target, runs[-1]
+        else:
+            self.root, self.path = os.path.dirname(os.path.dirname(os.path.abspath(target))), target
+        self.entries = {}
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.entries[entry['key']] = entry
+        self._bodies = {}
+        self.misses = 0
+        print(f"📼 重播 FHIR 回應: {self.path} ({len(self.entries)} 個請求)")
+
+    def body(self, digest):
+        content = self._bodies.get(digest)
+        if content is None:
+            with open(_object_path(self.root, digest), 'rb') as f:
+                content = self._bodies[digest] = gzip.decompress(f.read())
+        return content
+
+    def replay(self, method, url, body=None):
+        """回傳 (狀態碼, 標頭, 回應內容 bytes)"""
+        entry = self.entries.get(request_key(method, url, body))
+        if entry is None:
+            self.misses += 1
+            metrics.inc('replay_misses')
+            if self.misses <= MAX_MISS_LOG:
+                print(f"   ⚠️ 錄製檔中沒有此請求: {method.upper()} {url}")
+            raise ReplayMiss(f"{method.upper()} {url}")
+        metrics.inc('replay_hits')
+        return entry['status'], entry['headers'], self.body(entry['body'])
+
+
+_recorder = None
+_player = None
+_scratch = None
+
+
+def recorder():
+    """錄製模式時回傳 Recorder (第一次呼叫才建立索引檔)，否則 None"""
+    global _recorder
+    if CAPTURE_DIR and not REPLAY and _recorder is None:
+        _recorder = Recorder(CAPTURE_DIR)
+    return _recorder
+
+
+def player():
+    """重播模式時回傳 Player (第一次呼叫才載入索引)，否則 None"""
+    global _player
+    if REPLAY and _player is None:
+        _player = Player(REPLAY)
+    return _player
+
+
+def scratch_dir():
+    """重播模式用的暫存目錄 (第一次呼叫才建立，程式結束時刪除)"""
+    global _scratch
+    if _scratch is None:
+        _scratch = tempfile.mkdtemp(prefix="kpim_replay_")
+        atexit.register(shutil.rmtree, _scratch, ignore_errors=True)
+    return _scratch
+
+
+def _summary(root):
+    for path in sorted(glob.glob(os.path.join(root, 'runs', '*.jsonl'))):
+        with open(path, 'r', encoding='utf-8') as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+        size = sum(e['size'] for e in entries)
+        stored = sum(os.path.getsize(_object_path(root, d)) for d in {e['body'] for e in entries}
+                     if os.path.exists(_object_path(root, d)))
+        print(f"{os.path.basename(path)}: {len(entries)} 個請求，內容 {size / 1024 / 1024:.1f} MiB，"
+              f"壓縮後 {stored / 1024 / 1024:.1f} MiB")
+
+
+if __name__ == "__main__":
+    _summary(sys.argv[1] if len(sys.argv) > 1 else (CAPTURE_DIR or '.'))
@@ -0,0 +1,142 @@
+import asyncio
+import os
+import ssl
+import aiohttp
+import run_metrics as metrics
+
+# ==========================================
+# 共用 HTTP 連線池 (FHIR 與 Supabase)
+# ==========================================
+# FHIRClient 與 supabase_upload 的所有請求都經過 request()：同一個事件迴圈共用一個連線池，
+# 連線 keep-alive 重複使用、DNS 查詢結果快取，不再每個請求 / 每個表格重新握手 TLS。
+#   認證：configure_auth(網址前綴, 標頭) 登記一次，之後該前綴下的請求自動帶上 (最長前綴優先)
+#   TLS：預設驗證憑證；KPIM_CA_BUNDLE 指定自簽 CA；KPIM_TLS_VERIFY=0 才關閉驗證 (會印出警告)
+#   HTTP/2：KPIM_HTTP2=1 且安裝了 httpx[http2] 時改用 httpx (aiohttp 不支援 HTTP/2)，否則維持 HTTP/1.1
+# 連線池綁定事件迴圈，進入點結束前要 await close()；run_profile.run 會自動處理。
+LIMIT = int(os.environ.get("KPIM_HTTP_LIMIT", "100"))
+LIMIT_PER_HOST = int(os.environ.get("KPIM_HTTP_LIMIT_PER_HOST", "64"))   # 不低於 adaptive_limit 的上限，排隊才不會被算成延遲
+KEEPALIVE_SECONDS = float(os.environ.get("KPIM_HTTP_KEEPALIVE", "30"))
+DNS_CACHE_SECONDS = int(os.environ.get("KPIM_DNS_CACHE_SECONDS", "300"))
+TIMEOUT_SECONDS = float(os.environ.get("KPIM_HTTP_TIMEOUT", "60"))
+HTTP2 = os.environ.get("KPIM_HTTP2") == "1"
+CA_BUNDLE = os.environ.get("KPIM_CA_BUNDLE")
+TLS_VERIFY = os.environ.get("KPIM_TLS_VERIFY", "1") != "0"
+
+_auth = {}
+_backend = None
+_loop = None
+
+
+def configure_auth(base_url, headers):
+    """登記某個網址前綴 (例如 FHIR base 或 <supabase>/rest/v1) 的認證標頭"""
+    _auth[base_url.rstrip('/')] = dict(headers)
+
+
+def _auth_headers(url):
+    base = max((b for b in _auth if url.startswith(b)), key=len, default=None)
+    return _auth[base] if base else {}
+
+
+def _tls():
+    """aiohttp 的 ssl 參數：None 為預設驗證，False 為不驗證"""
+    if not TLS_VERIFY:
+        print("⚠️ KPIM_TLS_VERIFY=0：不驗證 TLS 憑證，僅限測試環境使用")
+        return False
+    if CA_BUNDLE:
+        return ssl.create_default_context(cafile=CA_BUNDLE)
+    return None
+
+
+class _AiohttpBackend:
+
+    def __init__(self):
+        connector = aiohttp.TCPConnector(limit=LIMIT, limit_per_host=LIMIT_PER_HOST,
+                                         keepalive_timeout=KEEPALIVE_SECONDS, ttl_dns_cache=DNS_CACHE_SECONDS,
+                                         ssl=_tls())
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(self._on_connect)
+        trace.on_dns_cache_miss.append(self._on_dns_miss)
+        self.session = aiohttp.ClientSession(connector=connector, trace_configs=[trace],
+                                             timeout=aiohttp.ClientTimeout(total=TIMEOUT_SECONDS))
+
+    @staticmethod
+    async def _on_connect(session, ctx, params):
+        metrics.inc('http_connections_opened')
+
+    @staticmethod
+    async def _on_dns_miss(session, ctx, params):
+        metrics.inc('http_dns_lookups', host=params.host)
+
+    async def request(self, method, url, body, headers, options):
+        async with self.session.request(method, url, data=body, headers=headers, **options) as r:
+            return r.status, r.headers, await r.read()
+
+    async def close(self):
+        await self.session.close()
+
+
+class _HttpxBackend:
+
+    def __init__(self, httpx):
+        self.httpx = httpx
+        self._warned = set()
+        tls = _tls()
+        limits = httpx.Limits(max_connections=LIMIT, max_keepalive_connections=LIMIT,
+                              keepalive_expiry=KEEPALIVE_SECONDS)
+        self.client = httpx.AsyncClient(http2=True, limits=limits, timeout=TIMEOUT_SECONDS,
+                                        verify=True if tls is None else tls)
+
+    async def request(self, method, url, body, headers, options):
+        kwargs = {}
+        for name, value in options.items():
+            if name == 'timeout':
+                kwargs['timeout'] = getattr(value, 'total', value)   # aiohttp.ClientTimeout 或秒數
+            elif name not in self._warned:
+                self._warned.add(name)
+                print(f"⚠️ HTTP/2 (httpx) 不支援 aiohttp 選項 {name}，已忽略")
+        try:
+            r = await self.client.request(method, url, content=body, headers=headers, **kwargs)
+        except self.httpx.TransportError as e:
+            # 統一成 aiohttp 的例外，呼叫端 (FHIRClient 重試) 只需處理一種
+            raise aiohttp.ClientConnectionError(str(e)) from e
+        return r.status_code, r.headers, r.content
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def _create():
+    if HTTP2:
+        try:
+            import httpx
+            import h2  # noqa: F401  httpx 的 HTTP/2 需要 h2
+            return _HttpxBackend(httpx)
+        except ImportError:
+            print("⚠️ KPIM_HTTP2=1 但未安裝 httpx[http2]，改用 HTTP/1.1")
+    return _AiohttpBackend()
+
+
+async def request(method, url, body=None, headers=None, **options):
+    """送出請求，回傳 (狀態碼, 回應標頭, 回應內容 bytes)；options 為 aiohttp 的請求參數 (timeout、ssl、proxy…)"""
+    global _backend, _loop
+    loop = asyncio.get_running_loop()
+    if _backend is None or _loop is not loop:
+        _backend, _loop = _create(), loop
+    return await _backend.request(method, url, body, {**_auth_headers(url), **(headers or {})}, options)
+
+
+async def close():
+    """關閉目前事件迴圈的連線池"""
+    global _backend, _loop
+    backend, _backend = _backend, None
+    if backend is not None and _loop is asyncio.get_running_loop():
+        await backend.close()
+    _loop = None
+
+
+async def closing(coro):
+    """await coro，結束 (含例外) 時關閉連線池：asyncio.run(http_session.closing(main()))"""
+    try:
+        return await coro
+    finally:
+        await close()
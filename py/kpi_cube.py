@@ -0,0 +1,137 @@
+import json
+import os
+from supabase_upload import upsert_supabase, configured
+
+# ==========================================
+# KPI 預先聚合立方體 (醫院 × 科別 × 醫師 × 指標 × 月份)
+# ==========================================
+# 每個格子保存分子/分母 (不是比率)，因此可以再往上加總到任何層級。
+# 新明細進來時只更新受影響的格子；儀表板的下鑽與趨勢線直接查格子，不必重新 groupby。
+ALL = '*'
+DIMS = ('hospital', 'department', 'doctor', 'indicator', 'month')
+CUBE_PATH = os.environ.get("KPIM_CUBE_PATH", ".kpim_cube.json")
+CUBE_TABLE = "KPI_Cube"
+
+# 隨明細同步維護的彙總層級 (醫院 → 科別 → 醫師 的階層，每層都有「各月」與「全期」)
+_HIERARCHY = (0, 1, 2, 3)  # 保留前 N 個組織維度，其餘為 ALL
+
+
+def _rollup_keys(hospital, department, doctor, indicator, month):
+    org = (hospital, department, doctor)
+    for depth in _HIERARCHY:
+        prefix = org[:depth] + (ALL,) * (3 - depth)
+        yield prefix + (indicator, month)
+        yield prefix + (indicator, ALL)
+
+
+class KPICube:
+    """以字典保存 {(hospital, department, doctor, indicator, month): [分子, 分母]}
+
+    - add(row_id, ...): 加入或更新一筆明細；同一 row_id 再次加入時先扣除舊的貢獻，
+      重複同步不會重複計算
+    - remove(row_id): 扣除一筆明細 (FHIR 已刪除或超出查詢期間)
+    - cell(...): O(1) 取得任一層級格子的分子/分母 (省略的維度視為 ALL)
+    - children(...): 列出某格子下一層的所有格子 (供下鑽)
+    """
+
+    def __init__(self):
+        self.cells = {}
+        self.rows = {}      # row_id -> [hospital, department, doctor, indicator, month, 分子, 分母]
+        self._dirty = set()
+
+    def add(self, row_id, hospital, department, doctor, indicator, month, numerator, denominator=1):
+        old = self.rows.get(row_id)
+        new = [hospital, department, doctor, indicator, month, numerator, denominator]
+        if old == new: return
+        if old: self._apply(old, -1)
+        self.rows[row_id] = new
+        self._apply(new, 1)
+
+    def remove(self, row_id):
+        old = self.rows.pop(row_id, None)
+        if old: self._apply(old, -1)
+
+    def _apply(self, row, sign):
+        *dims, numerator, denominator = row
+        for key in _rollup_keys(*dims):
+            cell = self.cells.setdefault(key, [0, 0])
+            cell[0] += sign * numerator
+            cell[1] += sign * denominator
+            self._dirty.add(key)
+
+    def cell(self, hospital=ALL, department=ALL, doctor=ALL, indicator=ALL, month=ALL):
+        return tuple(self.cells.get((hospital, department, doctor, indicator, month), (0, 0)))
+
+    def rate(self, **dims):
+        """比率 (%)，分母為 0 時回傳 None"""
+        numerator, denominator = self.cell(**dims)
+        return numerator / denominator * 100 if denominator else None
+
+    def children(self, level, **fixed):
+        """列出 level 維度 (hospital/department/doctor) 下的所有格子，其餘條件以 fixed 指定"""
+        depth = DIMS.index(level) + 1
+        result = []
+        for key, (numerator, denominator) in self.cells.items():
+            if denominator <= 0: continue
+            if any(v == ALL for v in key[:depth]) or any(v != ALL for v in key[depth:3]): continue
+            if any(key[DIMS.index(d)] != v for d, v in fixed.items()): continue
+            result.append((dict(zip(DIMS, key)), numerator, denominator))
+        return result
+
+    def months(self, indicator):
+        return sorted({k[4] for k, c in self.cells.items() if k[3] == indicator and k[4] != ALL and c[1] > 0})
+
+    def trend(self, indicator, **org):
+        """某層級各月的 (月份, 分子, 分母)"""
+        return [(m, *self.cell(indicator=indicator, month=m, **org)) for m in self.months(indicator)]
+
+    # ---------- 持久化 ----------
+    def save(self, path=CUBE_PATH):
+        """連同尚未上傳的格子一起保存，上傳失敗或中斷時下次執行會補傳"""
+        tmp = f"{path}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'rows': self.rows, 'dirty': [list(k) for k in self._dirty]}, f,
+                      ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path=CUBE_PATH):
+        cube = cls()
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            for row_id, row in data['rows'].items():
+                cube.rows[row_id] = row
+                cube._apply(row, 1)
+            cube._dirty = {tuple(k) for k in data.get('dirty', [])}
+            print(f"🧊 載入 KPI 立方體 {path}: {len(cube.rows)} 筆明細、{len(cube.cells)} 個格子")
+        return cube
+
+    def dirty_rows(self):
+        """自上次上傳後有變動的格子 (對應 KPI_Cube 表欄位)"""
+        rows = []
+        for key in self._dirty:
+            numerator, denominator = self.cells[key]
+            hospital, department, doctor, indicator, month = key
+            rows.append({
+                "hospital": hospital,
+                "department": department,
+                "doctor": doctor,
+                "indicator_name": indicator,
+                "month": month,
+                "numerator": numerator,
+                "denominator": denominator,
+                "value": round(numerator / denominator * 100, 2) if denominator else 0.0
+            })
+        return rows
+
+    async def upload(self, table=CUBE_TABLE):
+        """只上傳有變動的格子至資料庫；沒有 Supabase 設定時保留變動標記，回傳 False"""
+        rows = self.dirty_rows()
+        if not rows: return True
+        if not configured():
+            print(f"Skipping Supabase upload for {table}: {len(rows)} cells kept for the next run")
+            return False
+        ok = await upsert_supabase(table, rows, ("hospital", "department", "doctor", "indicator_name", "month"))
+        if ok: self._dirty.clear()
+        return ok
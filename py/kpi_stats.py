@@ -0,0 +1,143 @@
+import math
+import numpy as np
+from kpi_cube import ALL, DIMS
+
+# ==========================================
+# 風險校正統計 (向量化)
+# ==========================================
+# 所有函式都接受 numpy 陣列 (分子 / 分母)，一次計算所有單位 (醫師、科別、醫院) 或
+# 單位 × 月份，不逐筆迴圈；分母為 0 的位置回傳 nan。
+Z_95 = 1.959964
+Z_998 = 3.090232   # 99.8% 雙尾，漏斗圖外側控制線
+Z_SPC = 3.0        # p-chart 3-sigma 控制線
+EXACT_MAX_N = 1000 # 分母不超過此值時漏斗圖控制線用精確二項分位數 (小 n 的常態近似會過度判定異常)
+
+
+def _rates(num, den):
+    num = np.asarray(num, dtype=float)
+    den = np.asarray(den, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = np.where(den > 0, num / den, np.nan)
+    return num, den, p
+
+
+def wilson_interval(num, den, z=Z_95):
+    """Wilson score 信賴區間 (比例，0~1)"""
+    num, den, p = _rates(num, den)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z2 = z * z
+        center = (p + z2 / (2 * den)) / (1 + z2 / den)
+        half = z * np.sqrt(p * (1 - p) / den + z2 / (4 * den * den)) / (1 + z2 / den)
+    return np.clip(center - half, 0, 1), np.clip(center + half, 0, 1)
+
+
+def _binom_quantiles(n, p0, q_lo, q_hi):
+    """Bin(n, p0) 的分位數：累積機率首次 ≥ q_lo / q_hi 的計數 (對數空間計算 pmf，n 大也不會下溢)"""
+    k = np.arange(n + 1)
+    log_choose = np.concatenate([[0.0], np.cumsum(np.log(np.arange(n, 0, -1)) - np.log(np.arange(1, n + 1)))])
+    log_pmf = log_choose + k * math.log(p0) + (n - k) * math.log1p(-p0)
+    cdf = np.cumsum(np.exp(log_pmf - log_pmf.max()))
+    cdf /= cdf[-1]
+    return np.searchsorted(cdf, q_lo), np.searchsorted(cdf, q_hi)
+
+
+def funnel_limits(den, p0, z=Z_998):
+    """漏斗圖控制線：以整體比率 p0 為中心，隨分母 n 收窄
+
+    n ≤ EXACT_MAX_N 時為 Bin(n, p0) 的雙尾分位數 / n (比率超出上限即單尾精確檢定 < 尾機率)，
+    更大的 n 用常態近似 p0 ± z·sqrt(p0(1-p0)/n)
+    """
+    den = np.asarray(den, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        se = np.sqrt(p0 * (1 - p0) / den)
+    se = np.where(den > 0, se, np.nan)
+    lo, hi = np.clip(p0 - z * se, 0, 1), np.clip(p0 + z * se, 0, 1)
+    if 0 < p0 < 1:
+        tail = math.erfc(z / math.sqrt(2)) / 2
+        small = (den > 0) & (den <= EXACT_MAX_N)
+        for n in np.unique(np.round(den[small])):
+            r_lo, r_hi = _binom_quantiles(int(n), p0, tail, 1 - tail)
+            at = small & (np.round(den) == n)
+            lo[at], hi[at] = r_lo / n, r_hi / n
+    return lo, hi
+
+
+def p_chart_limits(num, den, z=Z_SPC):
+    """SPC p-chart：num/den 為 (單位 × 月份) 矩陣，每個單位以自己的平均比率為中心線
+
+    回傳 (中心線[單位], 下限[單位×月], 上限[單位×月])
+    """
+    num = np.asarray(num, dtype=float)
+    den = np.asarray(den, dtype=float)
+    total = den.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        center = np.where(total > 0, num.sum(axis=1) / total, np.nan)
+        se = np.sqrt(center[:, None] * (1 - center[:, None]) / den)
+    se = np.where(den > 0, se, np.nan)
+    return center, np.clip(center[:, None] - z * se, 0, 1), np.clip(center[:, None] + z * se, 0, 1)
+
+
+def flag_outliers(num, den, p0=None):
+    """漏斗圖判定：2 = 高於 99.8% 上限、1 = 高於 95% 上限、0 = 正常、-1 = 低於 95% 下限
+
+    p0 未指定時以所有單位合計的比率為基準。回傳 dict (皆為與輸入同長度的陣列)。
+    """
+    num, den, p = _rates(num, den)
+    if p0 is None:
+        p0 = num.sum() / den.sum() if den.sum() > 0 else 0.0
+    lo95, hi95 = funnel_limits(den, p0, Z_95)
+    lo998, hi998 = funnel_limits(den, p0, Z_998)
+    ci_lo, ci_hi = wilson_interval(num, den)
+
+    flag = np.zeros(len(p), dtype=int)
+    flag[p > hi95] = 1
+    flag[p > hi998] = 2
+    flag[p < lo95] = -1
+    return {
+        'rate': p, 'ci_low': ci_lo, 'ci_high': ci_hi,
+        'limit95_low': lo95, 'limit95_high': hi95,
+        'limit998_low': lo998, 'limit998_high': hi998,
+        'flag': flag, 'p0': p0
+    }
+
+
+# ==========================================
+# 由 KPI 立方體取出陣列
+# ==========================================
+def cube_units(cube, level, indicator):
+    """某層級 (hospital/department/doctor) 所有單位的全期 (標籤, 分子陣列, 分母陣列)"""
+    cells = cube.children(level, indicator=indicator, month=ALL)
+    labels = [c for c, _, _ in cells]
+    return labels, np.array([n for _, n, _ in cells], dtype=float), np.array([d for _, _, d in cells], dtype=float)
+
+
+def cube_matrix(cube, level, indicator):
+    """某層級所有單位 × 月份的 (標籤, 月份, 分子矩陣, 分母矩陣)"""
+    labels, _, _ = cube_units(cube, level, indicator)
+    months = cube.months(indicator)
+    depth = DIMS.index(level) + 1
+    num = np.zeros((len(labels), len(months)))
+    den = np.zeros((len(labels), len(months)))
+    for i, label in enumerate(labels):
+        org = {d: label[d] for d in DIMS[:depth]}
+        for j, month in enumerate(months):
+            num[i, j], den[i, j] = cube.cell(indicator=indicator, month=month, **org)
+    return labels, months, num, den
+
+
+def analyze_cube(cube, indicator, levels=('hospital', 'department', 'doctor')):
+    """一次計算所有層級單位的信賴區間與漏斗圖判定；基準 p0 為整體比率"""
+    total_num, total_den = cube.cell(indicator=indicator)
+    p0 = total_num / total_den if total_den else 0.0
+
+    labels, nums, dens, level_names = [], [], [], []
+    for level in levels:
+        lv_labels, lv_num, lv_den = cube_units(cube, level, indicator)
+        labels += lv_labels
+        nums.append(lv_num)
+        dens.append(lv_den)
+        level_names += [level] * len(lv_labels)
+    result = flag_outliers(np.concatenate(nums), np.concatenate(dens), p0)
+    result.update({'labels': labels, 'level': level_names,
+                   'numerator': np.concatenate(nums), 'denominator': np.concatenate(dens)})
+    return result
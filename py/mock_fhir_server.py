@@ -0,0 +1,153 @@
+import asyncio
+import random
+import threading
+from datetime import datetime, timedelta, timezone
+from aiohttp import web
+
+# ==========================================
+# 本機模擬 FHIR 伺服器 (效能測試用)
+# ==========================================
+# 在背景執行緒跑 aiohttp，提供：
+#   GET  /fhir/Procedure?_count=&_offset=   分頁的合成手術資料 (含 next 連結)
+#   GET  /fhir/Patient?_id=a,b / Encounter  依 id 批次查詢
+#   GET/POST/DELETE /rest/v1/<table>        Supabase (PostgREST) 替身，只計數不保存
+# 資料由案例編號決定 (random.Random(i))，不佔記憶體、每次執行都相同；可設定筆數、單頁上限與注入延遲。
+# 伺服器有自己的事件迴圈，受測程式在主執行緒裡阻塞 (ETL、繪圖) 也不會拖慢它的回應。
+HOSPITALS = ("台北綜合醫院", "國立醫學中心", "市立聯合醫院")
+DEPARTMENTS = ("一般外科", "心臟外科", "骨科", "神經外科")
+DOCTORS_PER_DEPARTMENT = 8
+EVENT_RATE = 0.03   # 48 小時內死亡 / 病危出院的比例
+DAYS_BACK = 180
+
+
+def _iso(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%S+00:00')
+
+
+class MockFHIRServer:
+    """with MockFHIRServer(total=10000, latency=0.01) as server: server.fhir_url ..."""
+
+    def __init__(self, total=1000, latency=0.0, max_page=1000, host='127.0.0.1', port=0):
+        self.total = total
+        self.latency = latency
+        self.max_page = max_page
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self.today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        self._loop = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._stop = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def fhir_url(self):
+        return f"{self.base_url}/fhir"
+
+    # ---------- 合成資料 ----------
+    def case(self, i):
+        """第 i 筆案例的 (Procedure, Patient, Encounter)"""
+        rnd = random.Random(i)
+        hospital = rnd.choice(HOSPITALS)
+        department = rnd.choice(DEPARTMENTS)
+        doctor = f"{hospital[:2]}{department[:2]}醫師{rnd.randrange(DOCTORS_PER_DEPARTMENT)}"
+        op_start = self.today - timedelta(days=rnd.randint(0, DAYS_BACK), hours=rnd.randint(0, 12))
+        op_end = op_start + timedelta(hours=rnd.randint(1, 6))
+        admission = op_start - timedelta(days=1)
+        discharge = op_end + timedelta(days=rnd.randint(2, 10))
+        event = rnd.random() < EVENT_RATE
+
+        proc = {
+            'resourceType': 'Procedure', 'id': f"P{i}", 'status': 'completed',
+            'subject': {'reference': f"Patient/pt{i}"}, 'encounter': {'reference': f"Encounter/e{i}"},
+            'performedPeriod': {'start': _iso(op_start), 'end': _iso(op_end)},
+            'code': {'coding': [{'system': 'http://snomed.info/sct', 'code': '80146002', 'display': 'Appendectomy'}]},
+            'performer': [{'actor': {'reference': f"Practitioner/{doctor}", 'display': doctor}}]
+        }
+        patient = {'resourceType': 'Patient', 'id': f"pt{i}", 'gender': rnd.choice(('male', 'female'))}
+        if event:
+            patient['deceasedDateTime'] = _iso(op_end + timedelta(hours=rnd.randint(1, 47)))
+        encounter = {
+            'resourceType': 'Encounter', 'id': f"e{i}", 'status': 'finished',
+            'class': {'code': 'IMP'},
+            'period': {'start': _iso(admission), 'end': _iso(discharge)},
+            'serviceProvider': {'display': f"【{hospital}】{department}"}
+        }
+        return proc, patient, encounter
+
+    # ---------- 路由 ----------
+    def _bundle(self, resources, next_url=None):
+        bundle = {'resourceType': 'Bundle', 'type': 'searchset', 'entry': [{'resource': r} for r in resources]}
+        if next_url: bundle['link'] = [{'relation': 'next', 'url': next_url}]
+        return web.json_response(bundle)
+
+    async def _procedures(self, request):
+        count = min(int(request.query.get('_count', 100)), self.max_page)
+        offset = int(request.query.get('_offset', 0))
+        items = [self.case(i)[0] for i in range(offset, min(self.total, offset + count))]
+        next_url = None
+        if offset + count < self.total:
+            next_url = str(request.url.update_query({'_count': count, '_offset': offset + count}))
+        return self._bundle(items, next_url)
+
+    async def _by_id(self, request):
+        index = {'Patient': 1, 'Encounter': 2}.get(request.match_info['resource_type'])
+        if index is None: return self._bundle([])
+        items = []
+        for rid in request.query.get('_id', '').split(','):
+            digits = rid.lstrip('pte')
+            if digits.isdigit() and int(digits) < self.total:
+                items.append(self.case(int(digits))[index])
+        return self._bundle(items)
+
+    async def _rest_get(self, request):
+        return web.json_response([])
+
+    async def _rest_write(self, request):
+        await request.read()
+        return web.json_response([], status=201)
+
+    async def _rest_delete(self, request):
+        return web.Response(status=204)
+
+    @web.middleware
+    async def _middleware(self, request, handler):
+        self.requests += 1
+        if self.latency: await asyncio.sleep(self.latency)
+        return await handler(request)
+
+    # ---------- 啟動 / 停止 ----------
+    async def _serve(self):
+        app = web.Application(middlewares=[self._middleware])
+        app.router.add_get('/fhir/Procedure', self._procedures)
+        app.router.add_get('/fhir/{resource_type}', self._by_id)
+        app.router.add_get('/rest/v1/{table}', self._rest_get)
+        app.router.add_post('/rest/v1/{table}', self._rest_write)
+        app.router.add_delete('/rest/v1/{table}', self._rest_delete)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        self._stop = asyncio.Event()
+        self._ready.set()
+        await self._stop.wait()
+        await runner.cleanup()
+
+    def __enter__(self):
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self._serve())
+            self._loop.close()
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._loop.call_soon_threadsafe(self._stop.set)
+        self._thread.join()
@@ -0,0 +1,186 @@
+from datetime import datetime, timezone
+import numpy as np
+from fhir_paging import iter_pages
+import http_capture
+from adaptive_limit import map_bounded
+from render_charts import HBA1C_THRESHOLD, hba1c_job
+
+# ==========================================
+# 多病人 Observation 時間序列
+# ==========================================
+# 以 patient=a,b,c 一次查一批病人、沿 next 連結分頁、多批並行。
+# 只保留 (病人, 時間, 數值) 三個欄位，整個世代存成 CSR 形式的 numpy 陣列：
+#   patients[i] 的資料為 times/values[offsets[i]:offsets[i+1]]，依時間排序
+# 閾值判定、每人統計都是整個陣列的向量運算；繪圖前以 LTTB 降採樣。
+HBA1C_CODE = "http://loinc.org|4548-4"
+PATIENT_BATCH = 100   # 每次查詢的病人數 (URL 長度考量)
+PAGE_SIZE = 500
+MAX_POINTS = 500      # 每張圖最多點數
+
+
+def _epoch(raw):
+    dt = datetime.fromisoformat(raw.replace('Z', '+00:00'))
+    if dt.tzinfo is None: dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+
+class ObservationSeries:
+    """整個世代的數值時間序列
+
+    - add_resources(resources): 解析 Observation (dict) 暫存
+    - finalize(): 排序並轉成陣列 (可重複呼叫，新資料會併入)
+    - series(patient_id): 該病人的 (times, values)
+    - summary(threshold): 每人筆數、最新值、超標筆數與比例 (向量化)
+    """
+
+    def __init__(self):
+        self.patients = []
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.times = np.empty(0, dtype='datetime64[s]')
+        self.values = np.empty(0)
+        self._index = {}
+        self._pending = ([], [], [])   # 病人序號, epoch 秒, 數值
+
+    @classmethod
+    def from_resources(cls, resources):
+        series = cls()
+        series.add_resources(resources)
+        series.finalize()
+        return series
+
+    def add_resources(self, resources):
+        pids, times, values = self._pending
+        for o in resources:
+            try:
+                ref = (o.get('subject') or {}).get('reference', '')
+                raw_date = o.get('effectiveDateTime')
+                val = (o.get('valueQuantity') or {}).get('value')
+                if not ref or not raw_date or val is None: continue
+                t = _epoch(raw_date)
+            except (ValueError, AttributeError):
+                continue  # 略過格式錯誤的單筆資料
+            pid = ref.split('/')[-1]
+            i = self._index.get(pid)
+            if i is None:
+                i = self._index[pid] = len(self.patients)
+                self.patients.append(pid)
+            pids.append(i)
+            times.append(t)
+            values.append(float(val))
+
+    def finalize(self):
+        pids, times, values = self._pending
+        if not pids and len(self.offsets) == len(self.patients) + 1: return self
+        counts = np.diff(self.offsets)
+        old_pids = np.repeat(np.arange(len(counts)), counts)
+        all_pids = np.concatenate([old_pids, np.array(pids, dtype=np.int64)])
+        all_times = np.concatenate([self.times.astype(np.int64), np.array(times, dtype=np.int64)])
+        all_values = np.concatenate([self.values, np.array(values, dtype=float)])
+
+        order = np.lexsort((all_times, all_pids))
+        all_pids = all_pids[order]
+        self.times = all_times[order].astype('datetime64[s]')
+        self.values = all_values[order]
+        self.offsets = np.searchsorted(all_pids, np.arange(len(self.patients) + 1)).astype(np.int64)
+        self._pending = ([], [], [])
+        return self
+
+    def __len__(self):
+        return len(self.patients)
+
+    @property
+    def points(self):
+        return len(self.values)
+
+    def series(self, patient_id):
+        i = self._index[patient_id]
+        lo, hi = self.offsets[i], self.offsets[i + 1]
+        return self.times[lo:hi], self.values[lo:hi]
+
+    def above(self, threshold=HBA1C_THRESHOLD):
+        """每個點是否超標 (紅燈)，與 values 同長度"""
+        return self.values > threshold
+
+    def summary(self, threshold=HBA1C_THRESHOLD):
+        counts = np.diff(self.offsets)
+        has = counts > 0
+        starts = self.offsets[:-1][has]
+        last = self.offsets[1:][has] - 1
+        above = np.add.reduceat(self.above(threshold).astype(np.int64), starts) if len(starts) else np.zeros(0, np.int64)
+        return {
+            'patients': [p for p, h in zip(self.patients, has) if h],
+            'count': counts[has],
+            'latest_time': self.times[last],
+            'latest': self.values[last],
+            'above': above,
+            'above_pct': above / counts[has] * 100
+        }
+
+
+# ==========================================
+# 降採樣 (Largest-Triangle-Three-Buckets)
+# ==========================================
+def lttb(x, y, n_out):
+    """回傳保留點的索引：首尾固定，中間分成 n_out-2 桶，每桶保留與前一點、下一桶平均
+    所成三角形面積最大的點 (保留尖峰，折線外觀與原序列接近)"""
+    n = len(x)
+    if n_out >= n or n_out < 3: return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    idx = np.empty(n_out, dtype=np.int64)
+    idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            xc, yc = x[hi:edges[i + 2]].mean(), y[hi:edges[i + 2]].mean()
+        else:
+            xc, yc = x[-1], y[-1]
+        area = np.abs((x[a] - xc) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (yc - y[a]))
+        a = lo + int(np.argmax(area))
+        idx[i + 1] = a
+    return idx
+
+
+def downsample(times, values, max_points=MAX_POINTS):
+    idx = lttb(times.astype(np.int64), values, max_points)
+    return times[idx], values[idx]
+
+
+# ==========================================
+# 查詢
+# ==========================================
+async def fetch_series(client, patient_ids, code=HBA1C_CODE, batch_size=PATIENT_BATCH):
+    """批次、分頁、並行查詢多位病人的 Observation，回傳 ObservationSeries"""
+    ids = sorted(set(patient_ids))
+    series = ObservationSeries()
+    failed = []
+
+    async def fetch_batch(chunk):
+        params = {'patient': ",".join(chunk), 'code': code, '_count': PAGE_SIZE,
+                  '_elements': 'subject,effectiveDateTime,valueQuantity'}
+        try:
+            async for _, entries in iter_pages(client, 'Observation', params):
+                series.add_resources(entries)
+        except http_capture.ReplayMiss:
+            raise
+        except Exception as e:
+            print(f"   ⚠️ 批次查詢失敗 ({len(chunk)} 位病人): {e}")
+            failed.extend(chunk)
+
+    async for _ in map_bounded(fetch_batch, (ids[i:i + batch_size] for i in range(0, len(ids), batch_size))):
+        pass
+    series.finalize()
+    print(f"✅ 已下載 {len(series)}/{len(ids)} 位病人、共 {series.points} 筆數據" + (f" ({len(failed)} 位查詢失敗)" if failed else ""))
+    return series
+
+
+def chart_jobs(series, threshold=HBA1C_THRESHOLD, max_points=MAX_POINTS):
+    """每位病人一張 HbA1c 圖 (降採樣後)，供 render_charts 批次輸出"""
+    jobs = []
+    for pid in series.patients:
+        times, values = downsample(*series.series(pid), max_points)
+        if not len(values): continue
+        jobs.append(hba1c_job(pid, times.astype(object), values, threshold))
+    return jobs
@@ -0,0 +1,98 @@
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode
+import http_capture
+from adaptive_limit import map_bounded
+
+# ==========================================
+# 批次寫入 Observation (batch Bundle + 條件式新增)
+# ==========================================
+# 每個 Bundle 打包 BUNDLE_SIZE 筆 POST，並附上 ifNoneExist (patient + code + date)：
+# 伺服器已有同一病人、同一檢驗、同一時間的 Observation 時不會再新增，重跑不會產生重複資料。
+# 多個 Bundle 由固定數量的工作者並行送出 (adaptive_limit.map_bounded)。
+BUNDLE_SIZE = 100
+PROGRESS_EVERY = 10   # 每送完幾個 Bundle 印一次進度
+
+
+def hba1c_observation(patient_id, effective, value):
+    return {
+        'resourceType': 'Observation',
+        'status': 'final',
+        'code': {'coding': [{'system': 'http://loinc.org', 'code': '4548-4', 'display': 'HbA1c'}]},
+        'subject': {'reference': f'Patient/{patient_id}'},
+        'effectiveDateTime': effective,
+        'valueQuantity': {'value': value, 'unit': '%', 'system': 'http://unitsofmeasure.org', 'code': '%'}
+    }
+
+
+def weekly_dates(weeks, end=None):
+    """往回 weeks 週、每週一 00:00 (UTC) 一筆；對齊到週一，重跑時日期不變 (條件式新增才比對得到)"""
+    end = end or datetime.now(timezone.utc)
+    monday = (end - timedelta(days=end.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
+    return [(monday - timedelta(weeks=i)).strftime('%Y-%m-%dT%H:%M:%S+00:00') for i in range(weeks)]
+
+
+def observation_key(obs):
+    """ifNoneExist 查詢字串 (已 URL 編碼，時區的 '+' 會變成 %2B)"""
+    coding = obs['code']['coding'][0]
+    return urlencode({
+        'patient': obs['subject']['reference'],
+        'code': f"{coding['system']}|{coding['code']}",
+        'date': obs['effectiveDateTime']
+    })
+
+
+def conditional_entry(resource, if_none_exist):
+    return {
+        'resource': dict(resource),
+        'request': {'method': 'POST', 'url': resource['resourceType'], 'ifNoneExist': if_none_exist}
+    }
+
+
+def entry_status(entry):
+    """batch-response 每筆的 HTTP 狀態碼 (例如 "201 Created" -> 201)"""
+    try:
+        return int(str(entry.get('response', {}).get('status', '0')).split()[0])
+    except ValueError:
+        return 0
+
+
+async def post_batch(client, entries):
+    """送出一個 batch Bundle，回傳 batch-response 的 entry 列表 (順序與送出時相同)"""
+    bundle = {'resourceType': 'Bundle', 'type': 'batch', 'entry': entries}
+    result = await client.execute('', method='post', data=bundle)
+    return (result or {}).get('entry', [])
+
+
+async def write_observations(client, observations, bundle_size=BUNDLE_SIZE):
+    """批次寫入 Observation，回傳 {'created': 新增筆數, 'existing': 已存在筆數, 'failed': 失敗筆數}"""
+    # 同一批資料內的重複點先去掉 (同一 Bundle 內的條件式新增彼此看不到)
+    unique = {}
+    for o in observations:
+        unique.setdefault(observation_key(o), o)
+    unique = list(unique.items())
+    chunks = [unique[i:i + bundle_size] for i in range(0, len(unique), bundle_size)]
+    counts = {'created': 0, 'existing': 0, 'failed': 0}
+    sent = [0]
+
+    async def send(chunk):
+        try:
+            results = await post_batch(client, [conditional_entry(o, key) for key, o in chunk])
+        except http_capture.ReplayMiss:
+            raise
+        except Exception as e:
+            print(f"   ⚠️ Bundle 寫入失敗 ({len(chunk)} 筆): {e}")
+            results = []
+        for entry in results:
+            status = entry_status(entry)
+            if status == 201: counts['created'] += 1
+            elif 200 <= status < 300: counts['existing'] += 1
+            else: counts['failed'] += 1
+        counts['failed'] += max(0, len(chunk) - len(results))
+        sent[0] += 1
+        if sent[0] % PROGRESS_EVERY == 0 or sent[0] == len(chunks):
+            print(f"   ...已送出 {sent[0]}/{len(chunks)} 個 Bundle")
+
+    async for _ in map_bounded(send, chunks):
+        pass
+    print(f"✅ Observation 寫入完成: 新增 {counts['created']} 筆、已存在 {counts['existing']} 筆、失敗 {counts['failed']} 筆")
+    return counts
@@ -0,0 +1,208 @@
+import multiprocessing
+import os
+import re
+import sys
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import run_metrics as metrics
+
+# ==========================================
+# 圖表批次輸出 (無視窗 / 多行程)
+# ==========================================
+# matplotlib 只在真正要畫圖時才載入；伺服器上 (或設定 KPIM_RENDER_DIR 時) 使用 Agg 後端
+# 直接輸出 PNG/SVG，不開視窗。每張圖是一個可序列化的 job dict，由行程池平行繪製。
+RENDER_DIR = os.environ.get("KPIM_RENDER_DIR")
+RENDER_FORMATS = tuple(os.environ.get("KPIM_RENDER_FORMATS", "png").split(","))
+RENDER_WORKERS = int(os.environ.get("KPIM_RENDER_WORKERS", "0")) or None  # None = CPU 數量
+DEFAULT_DIR = "kpim_charts"
+HBA1C_THRESHOLD = 6.5
+# 標題含中文的醫院 / 科別 / 醫師名稱；matplotlib 預設的 DejaVu Sans 沒有中文字，依序取第一個已安裝的字型
+CJK_FONTS = tuple(os.environ.get("KPIM_CJK_FONTS", "Noto Sans CJK TC,Noto Sans TC,Microsoft JhengHei,PingFang TC,"
+                                 "Heiti TC,WenQuanYi Zen Hei,Noto Sans CJK JP,Arial Unicode MS").split(","))
+_fonts_ready = False
+
+
+def headless():
+    """沒有顯示器 (Linux 未設 DISPLAY) 或指定了輸出目錄時，改為輸出檔案"""
+    if RENDER_DIR: return True
+    return sys.platform.startswith('linux') and not os.environ.get('DISPLAY')
+
+
+def _pyplot(backend=None):
+    import matplotlib
+    if backend: matplotlib.use(backend)
+    import matplotlib.pyplot as plt
+    _setup_fonts(matplotlib)
+    return plt
+
+
+def _setup_fonts(matplotlib):
+    """把已安裝的中文字型排到 sans-serif 最前面 (每個行程只做一次)"""
+    global _fonts_ready
+    if _fonts_ready: return
+    _fonts_ready = True
+    from matplotlib import font_manager
+    installed = {f.name for f in font_manager.fontManager.ttflist}
+    cjk = [name for name in CJK_FONTS if name in installed]
+    if cjk:
+        matplotlib.rcParams['font.sans-serif'] = cjk + list(matplotlib.rcParams['font.sans-serif'])
+        matplotlib.rcParams['axes.unicode_minus'] = False   # 部分中文字型沒有 U+2212 負號
+        return
+    # 沒有中文字型：只在主行程提示一次，不讓每張圖的缺字警告灌滿 stderr
+    warnings.filterwarnings('ignore', message=r'Glyph \d+ .* missing from')
+    if multiprocessing.parent_process() is None:
+        print("⚠️ 找不到中文字型，圖表中的中文會顯示為方框；請安裝 Noto Sans CJK TC 或以 KPIM_CJK_FONTS 指定")
+
+
+def _slug(text):
+    return re.sub(r'[^\w\-]+', '_', str(text)).strip('_') or 'chart'
+
+
+# ---------- 各類圖表 ----------
+def draw_trend(plt, job):
+    """比率趨勢 + p-chart 管制上限 + 參考線"""
+    plt.figure(figsize=(10, 5))
+    plt.plot(job['x'], job['rate'], '-o', color='red', label='Mortality Rate')
+    if job.get('ucl') is not None:
+        plt.step(job['x'], job['ucl'], where='mid', color='orange', linestyle=':', label='p-chart UCL (3σ)')
+    if job.get('center') is not None:
+        plt.axhline(y=job['center'], color='orange', alpha=0.5)
+    if job.get('threshold') is not None:
+        plt.axhline(y=job['threshold'], color='gray', linestyle='--')
+    plt.title(job['title'])
+    plt.ylabel("Rate (%)")
+    plt.legend()
+    plt.grid(True, alpha=0.3)
+
+
+def draw_funnel(plt, job):
+    """漏斗圖：各單位 (分母, 比率) 散佈 + 95% / 99.8% 控制線"""
+    import numpy as np
+    from kpi_stats import funnel_limits, Z_95, Z_998
+    den = np.asarray(job['denominator'], dtype=float)
+    rate = np.asarray(job['rate'], dtype=float)
+    top = den.max() * 1.1 if len(den) else 2
+    n = np.unique(np.linspace(max(1, den.min() * 0.5 if len(den) else 1), max(2, top), 200).round())
+    plt.figure(figsize=(8, 6))
+    for z, style in ((Z_95, '--'), (Z_998, '-')):
+        lo, hi = funnel_limits(n, job['p0'], z)
+        plt.plot(n, hi * 100, style, color='gray')
+        plt.plot(n, lo * 100, style, color='gray')
+    plt.axhline(y=job['p0'] * 100, color='black', alpha=0.5)
+    colors = ['#D32F2F' if f >= 2 else '#FFA000' if f == 1 else '#388E3C' for f in job['flag']]
+    plt.scatter(den, rate * 100, c=colors, s=40, zorder=5)
+    plt.title(job['title'])
+    plt.xlabel("Cases (denominator)")
+    plt.ylabel("Rate (%)")
+    plt.grid(True, alpha=0.3)
+
+
+def draw_hba1c(plt, job):
+    """HbA1c 紅綠燈圖 (閾值以上為紅)"""
+    threshold = job.get('threshold', HBA1C_THRESHOLD)
+    plt.figure(figsize=(10, 6))
+    plt.plot(job['x'], job['value'], color='#1976D2', alpha=0.6, label='HbA1c')
+    plt.axhline(y=threshold, color='gray', linestyle='--', label=f'Threshold ({threshold}%)')
+    import numpy as np
+    colors = np.where(np.asarray(job['value']) > threshold, '#D32F2F', '#388E3C')
+    plt.scatter(job['x'], job['value'], c=colors, s=50, zorder=5)
+    plt.title(job['title'])
+    plt.xlabel("Date")
+    plt.ylabel("HbA1c (%)")
+    plt.legend()
+    plt.grid(True, alpha=0.3)
+    plt.gcf().autofmt_xdate()
+
+
+DRAWERS = {'trend': draw_trend, 'funnel': draw_funnel, 'hba1c': draw_hba1c}
+
+
+# ---------- 輸出 ----------
+def show(job):
+    """互動模式：開視窗顯示單張圖 (無顯示器時改為輸出檔案)"""
+    if headless():
+        return render_batch([job])
+    plt = _pyplot()
+    DRAWERS[job['kind']](plt, job)
+    plt.show()
+    return []
+
+
+def _init_worker():
+    _pyplot('Agg')
+
+
+def _render_one(job, out_dir, formats):
+    plt = _pyplot('Agg')
+    DRAWERS[job['kind']](plt, job)
+    paths = []
+    for fmt in formats:
+        path = os.path.join(out_dir, f"{job['name']}.{fmt}")
+        plt.savefig(path, dpi=100)
+        paths.append(path)
+    plt.close('all')
+    return paths
+
+
+def render_batch(jobs, out_dir=None, formats=RENDER_FORMATS, workers=RENDER_WORKERS):
+    """以行程池平行輸出多張圖，回傳檔案路徑列表"""
+    if not jobs: return []
+    out_dir = out_dir or RENDER_DIR or DEFAULT_DIR
+    os.makedirs(out_dir, exist_ok=True)
+    with metrics.span('render'):
+        if len(jobs) == 1 or workers == 1:
+            paths = [p for job in jobs for p in _render_one(job, out_dir, formats)]
+        else:
+            workers = workers or os.cpu_count() or 1
+            chunksize = max(1, len(jobs) // (workers * 4))
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+                results = pool.map(_render_one, jobs, [out_dir] * len(jobs), [formats] * len(jobs), chunksize=chunksize)
+                paths = [p for r in results for p in r]
+    metrics.add_rows('render', len(jobs))
+    print(f"🖼️ 已輸出 {len(jobs)} 張圖表至 {out_dir}/")
+    return paths
+
+
+# ---------- 由 KPI 立方體建立 job ----------
+def trend_job(name, title, trend, threshold=None):
+    """trend: [(月份, 分子, 分母), ...]"""
+    import numpy as np
+    from kpi_stats import p_chart_limits
+    months = [m for m, _, _ in trend]
+    num = np.array([n for _, n, _ in trend], dtype=float)
+    den = np.array([d for _, _, d in trend], dtype=float)
+    center, _, ucl = p_chart_limits(num[None, :], den[None, :])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rate = np.where(den > 0, num / den * 100, np.nan)
+    return {'kind': 'trend', 'name': name, 'title': title, 'x': months, 'rate': rate,
+            'ucl': ucl[0] * 100, 'center': center[0] * 100, 'threshold': threshold}
+
+
+def kpi_jobs(cube, indicator, threshold=None, title=None):
+    """全院、每家醫院、每個科別、每位醫師的趨勢圖，以及各層級的漏斗圖"""
+    title = title or indicator
+    from kpi_cube import DIMS
+    from kpi_stats import analyze_cube
+    jobs = [trend_job('trend_all', f"{title} - All", cube.trend(indicator), threshold)]
+    for level in ('hospital', 'department', 'doctor'):
+        depth = DIMS.index(level) + 1
+        for label, _, _ in cube.children(level, indicator=indicator, month='*'):
+            org = {d: label[d] for d in DIMS[:depth]}
+            name = f"trend_{level}_" + _slug("_".join(org.values()))
+            jobs.append(trend_job(name, f"{title} - {label[level]}", cube.trend(indicator, **org), threshold))
+
+    result = analyze_cube(cube, indicator)
+    for level in ('hospital', 'department', 'doctor'):
+        idx = [i for i, lv in enumerate(result['level']) if lv == level]
+        if not idx: continue
+        jobs.append({
+            'kind': 'funnel', 'name': f"funnel_{level}", 'title': f"{title} - Funnel by {level}",
+            'denominator': result['denominator'][idx], 'rate': result['rate'][idx],
+            'flag': result['flag'][idx], 'p0': result['p0']
+        })
+    return jobs
+
+
+def hba1c_job(patient_id, dates, values, threshold=HBA1C_THRESHOLD, title=None):
+    return {'kind': 'hba1c', 'name': f"hba1c_{_slug(patient_id)}", 'x': list(dates), 'value': list(values),
+            'threshold': threshold, 'title': title or f"Patient {patient_id} - HbA1c Trend"}
@@ -0,0 +1,168 @@
+import json
+import os
+import numpy as np
+
+# ==========================================
+# 滾動視窗比率 (7 / 30 / 90 日)
+# ==========================================
+# 每個單位 (全院、醫院、醫師…) 保存「逐日累積」的分子/分母陣列：
+#   cum[i] = 第 start+i 天 (含) 以前的總和
+# 任一視窗比率 = 兩個前綴和相減，O(1)；新增的日子只延伸陣列尾端，O(新增天數)。
+ROLLING_PATH = os.environ.get("KPIM_ROLLING_PATH", ".kpim_rolling.npz")
+WINDOWS = (7, 30, 90)
+
+
+class _Series:
+    __slots__ = ('start', 'size', 'num', 'den')
+
+    def __init__(self, start, capacity=64):
+        self.start = start          # 第 0 格對應的日期序號 (date.toordinal())
+        self.size = 0
+        self.num = np.zeros(capacity)
+        self.den = np.zeros(capacity)
+
+    def _grow(self, size):
+        if size > len(self.num):
+            capacity = max(size, len(self.num) * 2)
+            self.num = np.resize(self.num, capacity)
+            self.den = np.resize(self.den, capacity)
+        # 新的日子沒有資料：累積值沿用最後一天
+        if size > self.size:
+            self.num[self.size:size] = self.num[self.size - 1] if self.size else 0
+            self.den[self.size:size] = self.den[self.size - 1] if self.size else 0
+            self.size = size
+
+    def _prepend(self, start):
+        # 比目前起點更早的資料 (少見)：整段往後移，O(歷史長度)
+        shift = self.start - start
+        num, den, size = self.num[:self.size], self.den[:self.size], self.size
+        self.num = np.concatenate([np.zeros(shift), num, np.zeros(len(self.num) - size)])
+        self.den = np.concatenate([np.zeros(shift), den, np.zeros(len(self.den) - size)])
+        self.start, self.size = start, size + shift
+
+    def add_daily(self, day0, daily_num, daily_den):
+        """自 day0 起逐日加入分子/分母 (day0 在尾端時只花 O(len(daily)))"""
+        if day0 < self.start: self._prepend(day0)
+        i = day0 - self.start
+        n = len(daily_num)
+        self._grow(i + n)
+        self.num[i:i + n] += np.cumsum(daily_num)
+        self.den[i:i + n] += np.cumsum(daily_den)
+        if i + n < self.size:  # 補進舊日期：之後每天的累積值一併調整
+            self.num[i + n:self.size] += np.sum(daily_num)
+            self.den[i + n:self.size] += np.sum(daily_den)
+
+    def cum(self, day):
+        i = day - self.start
+        if i < 0: return 0.0, 0.0
+        i = min(i, self.size - 1)
+        return self.num[i], self.den[i]
+
+
+class RollingRates:
+    """多單位的滾動視窗比率引擎
+
+    - add(row_id, units, day, numerator, denominator): 加入一筆明細到多個單位；
+      同一 row_id 再次加入時先扣除舊值 (重複同步不會重複計算)
+    - add_many(rows): 同上，一次加入一批 (每個單位只更新一次陣列)
+    - remove(row_id): 扣除一筆明細 (FHIR 已刪除或超出查詢期間)
+    - window(unit, end_day, days): O(1) 取得 (分子, 分母, 比率%)
+    - series(unit, days): 每一天的滾動比率陣列 (向量化，供繪圖)
+    """
+
+    def __init__(self):
+        self.units = {}
+        self.rows = {}   # row_id -> [units, day, 分子, 分母]
+
+    def _series(self, unit, day):
+        s = self.units.get(unit)
+        if s is None: s = self.units[unit] = _Series(day)
+        return s
+
+    def add(self, row_id, units, day, numerator, denominator=1):
+        self.add_many([(row_id, units, day, numerator, denominator)])
+
+    def add_many(self, rows):
+        """一次加入多筆 (row_id, units, day, 分子, 分母)：先把每個單位的增量 (含扣除舊值)
+        以 np.bincount 彙總成逐日陣列，每個單位只呼叫一次 add_daily"""
+        deltas = {}   # unit -> ([日期序號], [分子], [分母])
+        def push(units, day, numerator, denominator):
+            for unit in units:
+                days, nums, dens = deltas.setdefault(unit, ([], [], []))
+                days.append(day)
+                nums.append(numerator)
+                dens.append(denominator)
+
+        for row_id, units, day, numerator, denominator in rows:
+            new = [list(units), day, numerator, denominator]
+            old = self.rows.get(row_id)
+            if old == new: continue
+            if old: push(old[0], old[1], -old[2], -old[3])
+            self.rows[row_id] = new
+            push(new[0], day, numerator, denominator)
+
+        for unit, (days, nums, dens) in deltas.items():
+            days = np.asarray(days)
+            day0 = int(days.min())
+            offsets = days - day0
+            self._series(unit, day0).add_daily(day0, np.bincount(offsets, weights=nums),
+                                               np.bincount(offsets, weights=dens))
+
+    def remove(self, row_id):
+        old = self.rows.pop(row_id, None)
+        if old:
+            for unit in old[0]:
+                self._series(unit, old[1]).add_daily(old[1], [-old[2]], [-old[3]])
+
+    def last_day(self):
+        return max((s.start + s.size - 1 for s in self.units.values() if s.size), default=None)
+
+    def window(self, unit, end_day, days):
+        s = self.units.get(unit)
+        if s is None: return 0.0, 0.0, None
+        n1, d1 = s.cum(end_day)
+        n0, d0 = s.cum(end_day - days)
+        numerator, denominator = n1 - n0, d1 - d0
+        return numerator, denominator, (numerator / denominator * 100 if denominator else None)
+
+    def series(self, unit, days):
+        """(日期序號陣列, 滾動比率% 陣列)；分母為 0 的日子為 nan"""
+        s = self.units[unit]
+        num = np.concatenate([np.zeros(days), s.num[:s.size]])
+        den = np.concatenate([np.zeros(days), s.den[:s.size]])
+        wn, wd = num[days:] - num[:-days], den[days:] - den[:-days]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rate = np.where(wd > 0, wn / wd * 100, np.nan)
+        return np.arange(s.start, s.start + s.size), rate
+
+    # ---------- 持久化 ----------
+    def save(self, path=ROLLING_PATH):
+        keys = list(self.units)
+        arrays = {}
+        for i, unit in enumerate(keys):
+            s = self.units[unit]
+            arrays[f"num{i}"] = s.num[:s.size]
+            arrays[f"den{i}"] = s.den[:s.size]
+        meta = {'units': [[json.dumps(u, ensure_ascii=False), self.units[u].start] for u in keys], 'rows': self.rows}
+        tmp = f"{path}.tmp.npz"
+        np.savez_compressed(tmp, meta=np.array(json.dumps(meta, ensure_ascii=False)), **arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path=ROLLING_PATH):
+        rr = cls()
+        if not os.path.exists(path): return rr
+        with np.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            for i, (unit, start) in enumerate(meta['units']):
+                s = _Series(start, 0)
+                s.num, s.den = data[f"num{i}"].copy(), data[f"den{i}"].copy()
+                s.size = len(s.num)
+                rr.units[_unit_key(json.loads(unit))] = s
+        rr.rows = {k: [[_unit_key(u) for u in v[0]], *v[1:]] for k, v in meta['rows'].items()}
+        return rr
+
+
+def _unit_key(u):
+    # JSON 會把 tuple 變成 list；還原成可當字典鍵的 tuple
+    return tuple(u) if isinstance(u, list) else u
@@ -0,0 +1,92 @@
+import json
+import os
+import http_capture
+
+# ==========================================
+# 執行日誌 (斷點續跑)
+# ==========================================
+# 長時間的生成 / 同步作業會把「已完成的步驟」逐筆追加到本機 JSON Lines 檔。
+# 程式中斷後重新執行時，讀回日誌即可從中斷處繼續，不會重複寫入。
+JOURNAL_DIR = os.environ.get("KPIM_JOURNAL_DIR", ".kpim_journal")
+FSYNC_EVERY = 100  # 每 N 筆強制落盤一次 (flush 每筆都做，足以承受程式崩潰)
+
+
+class RunJournal:
+    """以 (kind, key) 為索引的追加式執行日誌
+
+    - record(kind, key, payload): 記錄一個已完成的步驟 (立即 flush)
+    - get / has: 查詢先前執行是否已完成該步驟
+    - finish(): 整批作業成功結束後刪除日誌，下次執行從頭開始
+
+    meta 用來描述這次作業的條件 (例如查詢起始日)；若與日誌中的不同，
+    舊日誌視為另一個作業而捨棄。
+    """
+
+    def __init__(self, name, meta=None, journal_dir=None):
+        if journal_dir is None:
+            # 重播錄製檔時寫到暫存目錄，不影響正式執行留下的續跑紀錄
+            journal_dir = http_capture.scratch_dir() if http_capture.REPLAY else JOURNAL_DIR
+        self.path = os.path.join(journal_dir, f"{name}.jsonl")
+        self.meta = meta or {}
+        self._entries = {}
+        self._pending = 0
+        self.resumed = self._load()
+
+        os.makedirs(journal_dir, exist_ok=True)
+        self._fh = open(self.path, 'a', encoding='utf-8')
+        if not self.resumed:
+            self.record('meta', 'meta', self.meta)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return False
+
+        entries = {}
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # 最後一行寫到一半就中斷，之後的內容一律不採用
+                entries[(row['kind'], row['key'])] = row.get('payload')
+
+        if entries.get(('meta', 'meta')) != self.meta:
+            print(f"⚠️ 日誌 {self.path} 的作業條件不同，捨棄舊紀錄重新開始")
+            os.remove(self.path)
+            return False
+
+        self._entries = entries
+        print(f"♻️ 讀取日誌 {self.path}: 已有 {len(entries) - 1} 筆完成紀錄，從中斷處繼續")
+        return True
+
+    def record(self, kind, key, payload=None):
+        self._entries[(kind, str(key))] = payload
+        line = json.dumps({'kind': kind, 'key': str(key), 'payload': payload}, ensure_ascii=False)
+        self._fh.write(line + "\n")
+        self._fh.flush()
+        self._pending += 1
+        if self._pending >= FSYNC_EVERY:
+            os.fsync(self._fh.fileno())
+            self._pending = 0
+
+    def has(self, kind, key):
+        return (kind, str(key)) in self._entries
+
+    def get(self, kind, key, default=None):
+        return self._entries.get((kind, str(key)), default)
+
+    def entries(self, kind):
+        """依寫入順序回傳某類別的所有 {key: payload}"""
+        return {k: v for (c, k), v in self._entries.items() if c == kind}
+
+    def close(self):
+        if not self._fh.closed:
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+            self._fh.close()
+
+    def finish(self):
+        """作業完整結束：移除日誌"""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,244 @@
+import contextvars
+import json
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+# ==========================================
+# 執行量測 (span / 計數器 / 延遲直方圖)
+# ==========================================
+# 設定 KPIM_METRICS_DIR 才會啟用；未啟用時每個函式第一行就返回，幾乎沒有額外負擔。
+# 執行結束 (finish) 時輸出：
+#   <目錄>/<run>_<時間>.json  本次執行報告 (span 統計、各階段每秒筆數、HTTP 延遲分位數)
+#   <目錄>/<run>.prom         Prometheus text format (給 node_exporter textfile collector 抓取)
+METRICS_DIR = os.environ.get("KPIM_METRICS_DIR")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+MAX_SPAN_LOG = 5000   # 報告中保留的 span 明細上限 (統計不受影響)
+
+_NULL = nullcontext()
+_parent = contextvars.ContextVar('kpim_span', default=None)
+
+
+class _State:
+    def __init__(self):
+        self.enabled = False
+        self.run = None
+        self.started = None
+        self.t0 = 0.0
+        self.dir = None
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}   # key -> [各 bucket 次數..., +Inf 次數], 總和, 次數
+        self.spans = {}        # span 名稱 -> [次數, 總秒數, 最長秒數, 最早開始, 最晚結束]
+        self.span_log = []
+
+
+_state = _State()
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def enabled():
+    return _state.enabled
+
+
+def start(run, metrics_dir=None):
+    """每個進入點的 main() 開頭呼叫；未設定輸出目錄時維持停用"""
+    global _state
+    _state = _State()
+    _state.enabled = bool(metrics_dir or METRICS_DIR)
+    _state.run = run
+    _state.started = datetime.now()
+    _state.t0 = time.perf_counter()
+    _state.dir = metrics_dir or METRICS_DIR
+
+
+def span(name, **labels):
+    """量測一段程式的耗時 (with metrics.span('fetch.Procedure'): ...)；巢狀 span 會記錄父 span"""
+    if not _state.enabled: return _NULL
+    return _span(name, labels)
+
+
+@contextmanager
+def _span(name, labels):
+    parent = _parent.get()
+    token = _parent.set(name)
+    start_t = time.perf_counter()
+    try:
+        yield
+    finally:
+        end_t = time.perf_counter()
+        _parent.reset(token)
+        duration = end_t - start_t
+        s = _state.spans.get(name)
+        if s is None:
+            _state.spans[name] = [1, duration, duration, start_t, end_t]
+        else:
+            s[0] += 1
+            s[1] += duration
+            s[2] = max(s[2], duration)
+            s[3] = min(s[3], start_t)
+            s[4] = max(s[4], end_t)
+        if len(_state.span_log) < MAX_SPAN_LOG:
+            _state.span_log.append({'name': name, 'parent': parent, 'labels': labels,
+                                    'start': round(start_t - _state.t0, 6), 'seconds': round(duration, 6)})
+
+
+def inc(name, value=1, **labels):
+    if not _state.enabled: return
+    key = _key(name, labels)
+    _state.counters[key] = _state.counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    if not _state.enabled: return
+    _state.gauges[_key(name, labels)] = value
+
+
+def observe(name, value, **labels):
+    if not _state.enabled: return
+    key = _key(name, labels)
+    h = _state.histograms.get(key)
+    if h is None:
+        h = _state.histograms[key] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0]
+    h[0][bisect_left(LATENCY_BUCKETS, value)] += 1
+    h[1] += value
+    h[2] += 1
+
+
+def add_rows(stage, n):
+    """某階段處理的筆數；報告中以同名 span 的時間範圍換算每秒筆數"""
+    inc('rows', n, stage=stage)
+
+
+def http_request(service, method, resource, status, seconds, sent=0, received=0):
+    """一次 HTTP 請求 (FHIR / Supabase 共用)：次數、位元組、延遲直方圖"""
+    if not _state.enabled: return
+    labels = {'service': service, 'method': method.upper(), 'resource': resource or '-'}
+    inc('http_requests', 1, status=status, **labels)
+    inc('http_sent_bytes', sent, **labels)
+    inc('http_received_bytes', received, **labels)
+    observe('http_request_seconds', seconds, **labels)
+
+
+# ---------- 報告 ----------
+def _quantile(buckets, count, q):
+    # 以直方圖估計分位數 (取所在 bucket 的上界)
+    target = q * count
+    seen = 0
+    for bound, n in zip(LATENCY_BUCKETS + (float('inf'),), buckets):
+        seen += n
+        if seen >= target: return bound
+    return float('inf')
+
+
+def _stages():
+    stages = {}
+    for (name, labels), rows in _state.counters.items():
+        if name != 'rows': continue
+        stage = dict(labels)['stage']
+        s = _state.spans.get(stage)
+        seconds = (s[4] - s[3]) if s else time.perf_counter() - _state.t0
+        stages[stage] = {'rows': rows, 'seconds': round(seconds, 3),
+                         'rows_per_second': round(rows / seconds, 1) if seconds > 0 else None}
+    return stages
+
+
+def report():
+    def labeled(items):
+        return [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in items.items()]
+
+    return {
+        'run': _state.run,
+        'started': _state.started.isoformat(timespec='seconds'),
+        'seconds': round(time.perf_counter() - _state.t0, 3),
+        'spans': {name: {'count': s[0], 'total_seconds': round(s[1], 6), 'max_seconds': round(s[2], 6),
+                         'wall_seconds': round(s[4] - s[3], 6)} for name, s in _state.spans.items()},
+        'stages': _stages(),
+        'counters': labeled(_state.counters),
+        'gauges': labeled(_state.gauges),
+        'histograms': [{'name': name, 'labels': dict(labels), 'count': count, 'sum': round(total, 6),
+                        'p50': _quantile(buckets, count, 0.5), 'p95': _quantile(buckets, count, 0.95),
+                        'buckets': dict(zip([str(b) for b in LATENCY_BUCKETS] + ['+Inf'], buckets))}
+                       for (name, labels), (buckets, total, count) in _state.histograms.items()],
+        'span_log': _state.span_log
+    }
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _prom_labels(labels, extra=()):
+    items = [('run', _state.run), *labels, *extra]
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in items) + '}'
+
+
+def prometheus_text():
+    lines = []
+
+    def typed(name, kind):
+        lines.append(f"# TYPE kpim_{name} {kind}")
+
+    for name in sorted({n for n, _ in _state.counters}):
+        typed(f"{name}_total", 'counter')
+        for (n, labels), value in _state.counters.items():
+            if n == name: lines.append(f"kpim_{name}_total{_prom_labels(labels)} {value}")
+    for name in sorted({n for n, _ in _state.gauges}):
+        typed(name, 'gauge')
+        for (n, labels), value in _state.gauges.items():
+            if n == name: lines.append(f"kpim_{name}{_prom_labels(labels)} {value}")
+    for name in sorted({n for n, _ in _state.histograms}):
+        typed(name, 'histogram')
+        for (n, labels), (buckets, total, count) in _state.histograms.items():
+            if n != name: continue
+            cumulative = 0
+            for bound, c in zip([str(b) for b in LATENCY_BUCKETS] + ['+Inf'], buckets):
+                cumulative += c
+                lines.append(f"kpim_{name}_bucket{_prom_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"kpim_{name}_sum{_prom_labels(labels)} {total}")
+            lines.append(f"kpim_{name}_count{_prom_labels(labels)} {count}")
+    typed('span_seconds', 'gauge')
+    for name, s in _state.spans.items():
+        lines.append(f"kpim_span_seconds{_prom_labels([('span', name)])} {s[1]}")
+    typed('stage_rows_per_second', 'gauge')
+    for stage, s in _stages().items():
+        if s['rows_per_second'] is not None:
+            lines.append(f"kpim_stage_rows_per_second{_prom_labels([('stage', stage)])} {s['rows_per_second']}")
+    typed('run_seconds', 'gauge')
+    lines.append(f"kpim_run_seconds{_prom_labels([])} {time.perf_counter() - _state.t0}")
+    return "\n".join(lines) + "\n"
+
+
+def finish():
+    """寫出 JSON 報告與 .prom 檔，回傳 (json 路徑, prom 路徑)；未啟用時回傳 None"""
+    if not _state.enabled: return None
+    os.makedirs(_state.dir, exist_ok=True)
+    stamp = _state.started.strftime('%Y%m%d_%H%M%S')
+    json_path = os.path.join(_state.dir, f"{_state.run}_{stamp}.json")
+    prom_path = os.path.join(_state.dir, f"{_state.run}.prom")
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(report(), f, ensure_ascii=False, indent=2, default=str)
+    tmp = f"{prom_path}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(prometheus_text())
+    os.replace(tmp, prom_path)   # textfile collector 不會讀到寫一半的檔案
+    print(f"📏 執行量測已輸出: {json_path}、{prom_path}")
+    for stage, s in _stages().items():
+        print(f"   {stage}: {s['rows']} 筆 / {s['seconds']} 秒 ({s['rows_per_second']} 筆/秒)")
+    return json_path, prom_path
+
+
+@contextmanager
+def run(name, metrics_dir=None):
+    """with metrics.run('Get_KPIM_DATA'): ... 包住整個 main()，結束 (含例外) 時輸出報告"""
+    start(name, metrics_dir)
+    try:
+        with span('run'):
+            yield
+    finally:
+        finish()
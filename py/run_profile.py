@@ -0,0 +1,154 @@
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import re
+import time
+import tracemalloc
+from datetime import datetime
+import http_session
+
+# ==========================================
+# 效能剖析模式 (cProfile / tracemalloc / asyncio)
+# ==========================================
+# 進入點以 run_profile.run('名稱', main) 取代 asyncio.run(main())。
+# 設定 KPIM_PROFILE_DIR 才會啟用，否則等同 asyncio.run。啟用時在該目錄寫出 (同一個時間戳記)：
+#   <名稱>_<時間>.pstats         cProfile 原始資料 (python -m pstats 或 snakeviz 開啟、跨版本比較)
+#   <名稱>_<時間>_cprofile.txt   依累計時間 / 自身時間排序的前幾名函式
+#   <名稱>_<時間>_memory.txt     tracemalloc 記憶體峰值與結束時前幾名配置位置
+#   <名稱>_<時間>_asyncio.txt    各協程的 task 數量與存活時間、同時存在的 task 上限、慢回呼統計
+# 注意：cProfile 只量測事件迴圈所在的主執行緒 (render_batch 的行程池另見 run_metrics 的 span)。
+# 結束時一併關閉 http_session 的共用連線池。
+PROFILE_DIR = os.environ.get("KPIM_PROFILE_DIR")
+SLOW_CALLBACK_SECONDS = float(os.environ.get("KPIM_SLOW_CALLBACK_SECONDS", "0.05"))
+TRACEMALLOC_FRAMES = 1   # 每個配置保留的堆疊深度 (越深越準、額外負擔越大)
+TOP_N = 40
+
+
+class _TaskStats:
+    """以 task factory 記錄每個 task 的協程名稱與存活時間"""
+
+    def __init__(self):
+        self.by_coro = {}     # 協程名稱 -> [task 數, 總存活秒數, 最長存活秒數]
+        self.alive = 0
+        self.max_alive = 0
+
+    def factory(self, loop, coro, **kwargs):
+        task = asyncio.Task(coro, loop=loop, **kwargs)
+        name = getattr(coro, '__qualname__', type(coro).__name__)
+        started = time.perf_counter()
+        self.alive += 1
+        self.max_alive = max(self.max_alive, self.alive)
+
+        def done(_):
+            self.alive -= 1
+            lifetime = time.perf_counter() - started
+            s = self.by_coro.setdefault(name, [0, 0.0, 0.0])
+            s[0] += 1
+            s[1] += lifetime
+            s[2] = max(s[2], lifetime)
+
+        task.add_done_callback(done)
+        return task
+
+
+class _SlowCallbacks(logging.Handler):
+    """攔截 asyncio debug 模式的「Executing <Handle ...> took N seconds」警告並彙總"""
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.by_callback = {}   # 回呼 -> [次數, 總秒數, 最長秒數]
+        self.other = []
+
+    def emit(self, record):
+        if record.msg.startswith('Executing') and len(record.args or ()) == 2:
+            handle, seconds = record.args
+            key = re.sub(r" at 0x[0-9a-f]+|name='Task-\d+' ", '', repr(handle))[:300]
+            s = self.by_callback.setdefault(key, [0, 0.0, 0.0])
+            s[0] += 1
+            s[1] += seconds
+            s[2] = max(s[2], seconds)
+        else:
+            self.other.append(record.getMessage())
+
+
+def _write_cprofile(profiler, path):
+    out = io.StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.strip_dirs()
+    out.write("=== 依累計時間 (cumulative) ===\n")
+    stats.sort_stats('cumulative').print_stats(TOP_N)
+    out.write("\n=== 依自身時間 (tottime) ===\n")
+    stats.sort_stats('tottime').print_stats(TOP_N)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(out.getvalue())
+
+
+def _write_memory(peak, current, snapshot, path):
+    lines = [f"峰值: {peak / 1024 / 1024:.1f} MiB", f"結束時: {current / 1024 / 1024:.1f} MiB", "",
+             f"=== 結束時仍存在的配置 (前 {TOP_N} 名，依位置) ==="]
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, tracemalloc.__file__),
+    ))
+    for stat in snapshot.statistics('lineno')[:TOP_N]:
+        lines.append(f"{stat.size / 1024:10.1f} KiB  {stat.count:8d} 個  {stat.traceback}")
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def _write_asyncio(tasks, slow, path):
+    lines = [f"同時存在的 task 上限: {tasks.max_alive}", f"慢回呼門檻: {SLOW_CALLBACK_SECONDS} 秒", "",
+             "=== Task (依總存活時間) ===", f"{'數量':>8} {'總秒數':>10} {'最長秒數':>10}  協程"]
+    for name, (count, total, longest) in sorted(tasks.by_coro.items(), key=lambda kv: -kv[1][1]):
+        lines.append(f"{count:8d} {total:10.3f} {longest:10.3f}  {name}")
+    lines += ["", "=== 慢回呼 (阻塞事件迴圈，依總秒數) ===", f"{'次數':>8} {'總秒數':>10} {'最長秒數':>10}  回呼"]
+    for key, (count, total, longest) in sorted(slow.by_callback.items(), key=lambda kv: -kv[1][1]):
+        lines.append(f"{count:8d} {total:10.3f} {longest:10.3f}  {key}")
+    if slow.other:
+        lines += ["", "=== 其他 asyncio 警告 ==="] + slow.other[:TOP_N]
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def run(name, main, profile_dir=None):
+    """執行 main() 協程；啟用剖析時同時收集 cProfile、tracemalloc 與 asyncio 統計"""
+    profile_dir = profile_dir or PROFILE_DIR
+    if not profile_dir:
+        return asyncio.run(http_session.closing(main()))
+
+    os.makedirs(profile_dir, exist_ok=True)
+    prefix = os.path.join(profile_dir, f"{name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+    tasks = _TaskStats()
+    slow = _SlowCallbacks()
+    logger = logging.getLogger('asyncio')
+    propagate = logger.propagate
+    logger.addHandler(slow)
+    logger.propagate = False   # 慢回呼只彙總到檔案，不逐筆印在畫面上
+    profiler = cProfile.Profile()
+    tracemalloc.start(TRACEMALLOC_FRAMES)
+    try:
+        with asyncio.Runner(debug=True) as runner:
+            loop = runner.get_loop()
+            loop.slow_callback_duration = SLOW_CALLBACK_SECONDS
+            loop.set_task_factory(tasks.factory)
+            profiler.enable()
+            try:
+                return runner.run(http_session.closing(main()))
+            finally:
+                profiler.disable()
+    finally:
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        logger.removeHandler(slow)
+        logger.propagate = propagate
+
+        profiler.dump_stats(f"{prefix}.pstats")
+        _write_cprofile(profiler, f"{prefix}_cprofile.txt")
+        _write_memory(peak, current, snapshot, f"{prefix}_memory.txt")
+        _write_asyncio(tasks, slow, f"{prefix}_asyncio.txt")
+        print(f"🔬 效能剖析已輸出: {prefix}.pstats / _cprofile.txt / _memory.txt / _asyncio.txt "
+              f"(記憶體峰值 {peak / 1024 / 1024:.1f} MiB)")
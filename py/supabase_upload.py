@@ -0,0 +1,320 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from urllib.parse import quote
+import http_capture
+import http_session
+import run_metrics as metrics
+
+# ==========================================
+# Supabase 上傳 (批次 / 管線模式)
+# ==========================================
+UPLOAD_BATCH_SIZE = 500
+FLUSH_SECONDS = 2.0       # 佇列閒置超過此秒數就先送出未滿的批次
+SUMMARY_FLUSH_SECONDS = 10.0
+KPI_CONFLICT_KEY = ("department", "doctor", "indicator_name")  # 對應 KPI 表的 UNIQUE 限制
+DETAIL_CONFLICT_KEY = ("row_key",)  # 對應 KPI_Detail 表的 UNIQUE 限制
+SELECT_PAGE_SIZE = 1000   # PostgREST 預設單次最多回傳 1000 列
+MAX_FILTER_LENGTH = 6000  # 刪除條件放在網址中，常見伺服器 / 代理的請求列上限約 8 KB
+
+# Load env vars from .env.local manually
+def load_env(path='.env.local'):
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                if '=' in line and not line.startswith('#'):
+                    key, val = line.strip().split('=', 1)
+                    val = val.strip('"').strip("'")
+                    os.environ[key] = val
+        print("Env vars loaded from .env.local")
+    except Exception as e:
+        print(f"No .env.local found or error reading it: {e}")
+
+def _credentials():
+    """讀取 Supabase 網址與金鑰，並把認證標頭登記到共用連線池；
+    重播 FHIR 錄製檔 (http_capture) 時回傳 (None, None)，所有讀寫都略過，不碰正式資料庫"""
+    if http_capture.REPLAY: return None, None
+    supabase_url, supabase_key = os.environ.get("NEXT_PUBLIC_SUPABASE_URL"), os.environ.get("NEXT_PUBLIC_SUPABASE_ANON_KEY")
+    if supabase_url and supabase_key:
+        http_session.configure_auth(f"{supabase_url}/rest/v1", {
+            "apikey": supabase_key,
+            "Authorization": f"Bearer {supabase_key}"
+        })
+    return supabase_url, supabase_key
+
+def configured():
+    """是否有可用的 Supabase 網址與金鑰 (沒有時各上傳函式只印出略過訊息並回傳成功)"""
+    supabase_url, supabase_key = _credentials()
+    return bool(supabase_url and supabase_key)
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+async def _request(method, url, table, headers=JSON_HEADERS, body=None):
+    """經由共用連線池送出 PostgREST 請求並記錄次數、位元組與延遲，回傳 (狀態碼, 回應內容 bytes)"""
+    started = time.perf_counter()
+    status, content = 'error', b''
+    try:
+        status, _, content = await http_session.request(method, url, body, headers)
+        return status, content
+    finally:
+        metrics.http_request('supabase', method, table, status, time.perf_counter() - started,
+                             len(body or b''), len(content))
+
+# ==========================================
+# 明細列鍵值與內容雜湊
+# ==========================================
+# row_key = 來源系統 | Procedure id | 指標名稱，同一筆手術的同一指標永遠對應同一列；
+# row_hash 為其餘欄位的 SHA-256，用來判斷內容是否變動。
+# Next.js 的 syncFhirData 以相同算法計算，並與 Get_KPIM_DATA.to_detail_row 產生相同欄位，
+# 所以兩邊同步同一台 FHIR 伺服器時共用 source_system / row_key，雜湊也一致
+def row_key(source_system, procedure_id, indicator_name):
+    return f"{source_system}|{procedure_id}|{indicator_name}"
+
+def row_hash(row):
+    content = {k: v for k, v in row.items() if k not in ('row_key', 'row_hash')}
+    canonical = json.dumps(content, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def keyed_row(row, source_system, procedure_id):
+    """加上 source_system / procedure_id / row_key / row_hash 欄位"""
+    row = {**row, "source_system": source_system, "procedure_id": procedure_id}
+    row['row_key'] = row_key(source_system, procedure_id, row['indicator_name'])
+    row['row_hash'] = row_hash(row)
+    return row
+
+async def fetch_stored_hashes(table, source_system):
+    """讀取資料庫中某來源系統現有的 {row_key: row_hash}"""
+    supabase_url, supabase_key = _credentials()
+    if not supabase_url or not supabase_key: return {}
+
+    stored = {}
+    offset = 0
+    while True:
+        url = (f"{supabase_url}/rest/v1/{table}?select=row_key,row_hash"
+               f"&source_system=eq.{quote(source_system, safe='')}"
+               f"&order=row_key&limit={SELECT_PAGE_SIZE}&offset={offset}")
+        status, content = await _request('GET', url, table)
+        if status >= 300:
+            raise RuntimeError(f"Error reading {table}: {status} - {content.decode('utf-8')}")
+        rows = json.loads(content)
+        stored.update({r['row_key']: r['row_hash'] for r in rows if r['row_key']})
+        if len(rows) < SELECT_PAGE_SIZE: return stored
+        offset += SELECT_PAGE_SIZE
+
+def _in_lists(values, max_length=MAX_FILTER_LENGTH):
+    """把 values 切成多個 PostgREST in.(...) 清單 (已編碼)，每個不超過 max_length 字元"""
+    chunk, length = [], 0
+    for value in values:
+        item = quote('"' + value.replace('"', '\\"') + '"', safe='')
+        if chunk and length + len(item) + 3 > max_length:
+            yield "%2C".join(chunk)
+            chunk, length = [], 0
+        chunk.append(item)
+        length += len(item) + 3
+    if chunk: yield "%2C".join(chunk)
+
+async def delete_rows(table, keys):
+    """依 row_key 刪除資料列，回傳 False 表示刪除失敗
+    完整的 row_key 很長 (來源網址 + 中文指標名稱)，所以拆回 source_system / indicator_name 分組，
+    網址只帶 procedure_id 清單，並依編碼後長度分批"""
+    supabase_url, supabase_key = _credentials()
+    if not supabase_url or not supabase_key or not keys: return True
+
+    groups = {}
+    for key in sorted(keys):
+        source_system, procedure_id, indicator_name = key.rsplit('|', 2)
+        groups.setdefault((source_system, indicator_name), []).append(procedure_id)
+    urls = [f"{supabase_url}/rest/v1/{table}?source_system=eq.{quote(source_system, safe='')}"
+            f"&indicator_name=eq.{quote(indicator_name, safe='')}&procedure_id=in.({ids})"
+            for (source_system, indicator_name), procedure_ids in groups.items()
+            for ids in _in_lists(procedure_ids)]
+    for url in urls:
+        try:
+            status, content = await _request('DELETE', url, table)
+            if status >= 300:
+                print(f"Error deleting from {table}: {status} - {content.decode('utf-8')}")
+                return False
+        except Exception as e:
+            print(f"Exception deleting from {table}: {e}")
+            return False
+    print(f"Deleted {len(keys)} stale records from {table}")
+    return True
+
+async def upsert_supabase(table, data, on_conflict=None):
+    """上傳資料至 Supabase，回傳 False 表示上傳失敗 (可重試)"""
+    supabase_url, supabase_key = _credentials()
+    if not supabase_url or not supabase_key:
+        print(f"Skipping Supabase upload for {table}: {'Replay Mode' if http_capture.REPLAY else 'Missing Credentials'}")
+        return True
+
+    headers = {**JSON_HEADERS, "Prefer": "resolution=merge-duplicates"}
+
+    url = f"{supabase_url}/rest/v1/{table}"
+    if on_conflict:
+        url += f"?on_conflict={','.join(on_conflict)}"
+
+    # Simple Loop upload to avoid batch limits or just send whole batch if small enough
+    # Supabase REST usually handles array body as insert.
+    try:
+        encoded_data = json.dumps(data).encode('utf-8')
+        status, content = await _request('POST', url, table, headers, encoded_data)
+        if status >= 300:
+             print(f"Error uploading to {table}: {status} - {content.decode('utf-8')}")
+             return False
+        print(f"Uploaded {len(data)} records to {table}")
+        return True
+    except Exception as e:
+        print(f"Exception uploading to {table}: {e}")
+        return False
+
+
+_STOP = object()
+
+class BatchUploader:
+    """背景批次上傳器
+
+    生產端 (FHIR 寫入或 ETL) 以 put() 丟入明細列，背景 task 湊滿一批就經由共用連線池
+    非同步上傳，上傳期間生產端照常進行；佇列滿了才會讓生產端等待 (背壓)。
+    有日誌時，每批成功後記錄該批的列鍵值，續跑時已上傳的列會被略過。
+
+    baseline 為資料庫現有的 {row_key: row_hash}；提供時只上傳新增或內容有變的列，
+    全部送完後可用 delete_stale() 刪除這次沒出現的舊列 (差異同步)。
+    """
+
+    def __init__(self, table, batch_size=UPLOAD_BATCH_SIZE, journal=None, on_conflict=DETAIL_CONFLICT_KEY,
+                 max_pending_batches=4, baseline=None):
+        self.table = table
+        self.batch_size = batch_size
+        self.journal = journal
+        self.on_conflict = on_conflict
+        self.baseline = baseline
+        self.queue = asyncio.Queue(maxsize=batch_size * max_pending_batches)
+        self.uploaded_rows = 0
+        self.failed_rows = 0
+        self.unchanged_rows = 0
+        self._seen_keys = set()
+        self._kind = f"uploaded:{table}"
+        self._batch_no = 0
+        self._done_keys = set()
+        if journal:
+            for keys in journal.entries(self._kind).values():
+                self._done_keys.update(keys)
+            self._batch_no = len(journal.entries(self._kind))
+        self._task = None
+
+    async def __aenter__(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.queue.put(_STOP)
+        await self._task
+
+    async def put(self, key, row):
+        if self.baseline is not None:
+            self._seen_keys.add(row['row_key'])
+            if self.baseline.get(row['row_key']) == row['row_hash']:
+                self.unchanged_rows += 1
+                return
+        if str(key) in self._done_keys: return
+        await self.queue.put((str(key), row))
+
+    async def delete_stale(self):
+        """刪除 baseline 中有、這次同步卻沒出現的列 (須在全部資料送完後呼叫)"""
+        stale = set(self.baseline or {}) - self._seen_keys
+        ok = await delete_rows(self.table, stale)
+        print(f"🔁 差異同步 {self.table}: 上傳 {self.uploaded_rows} 筆、未變 {self.unchanged_rows} 筆、刪除 {len(stale) if ok else 0} 筆")
+        return ok
+
+    async def _run(self):
+        batch = []
+        while True:
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout=FLUSH_SECONDS)
+            except asyncio.TimeoutError:
+                item = None
+
+            if item is _STOP:
+                if batch: await self._flush(batch)
+                return
+            if item is not None:
+                batch.append(item)
+            if batch and (item is None or len(batch) >= self.batch_size):
+                await self._flush(batch)
+                batch = []
+
+    async def _flush(self, batch):
+        keys = [k for k, _ in batch]
+        with metrics.span(f"upload.{self.table}"):
+            ok = await upsert_supabase(self.table, [r for _, r in batch], self.on_conflict)
+        if not ok:
+            self.failed_rows += len(batch)
+            return
+        self.uploaded_rows += len(batch)
+        metrics.add_rows(f"upload.{self.table}", len(batch))
+        if self.journal:
+            self.journal.record(self._kind, self._batch_no, keys)
+            self._batch_no += 1
+
+
+class KPISummary:
+    """KPI 匯總：隨明細列遞增累加分子/分母，定期只上傳有變動的匯總列"""
+
+    def __init__(self, table="KPI", key_fields=KPI_CONFLICT_KEY):
+        self.table = table
+        self.key_fields = key_fields
+        self.items = {}
+        self._dirty = set()
+
+    def add(self, row):
+        key = tuple(row[f] for f in self.key_fields)
+        item = self.items.get(key)
+        if item is None:
+            item = self.items[key] = {
+                "department": row['department'],
+                "doctor": row['doctor'],
+                "indicator_name": row['indicator_name'],
+                "indicator_def": row['indicator_def'],
+                "numerator": 0,
+                "denominator": 0,
+                "unit": row['unit']
+            }
+        item['numerator'] += row['numerator']
+        item['denominator'] += row['denominator']
+        self._dirty.add(key)
+
+    @property
+    def pending(self):
+        """尚未成功上傳的匯總列數"""
+        return len(self._dirty)
+
+    def rows(self, keys=None):
+        result = []
+        for key in (self.items if keys is None else keys):
+            item = dict(self.items[key])
+            if item['denominator'] > 0:
+                item['value'] = round((item['numerator'] / item['denominator']) * 100, 2)
+            else:
+                item['value'] = 0.0
+            result.append(item)
+        return result
+
+    async def flush(self):
+        if not self._dirty: return True
+        keys, self._dirty = self._dirty, set()
+        with metrics.span(f"upload.{self.table}"):
+            ok = await upsert_supabase(self.table, self.rows(keys), self.key_fields)
+        if ok: metrics.add_rows(f"upload.{self.table}", len(keys))
+        else: self._dirty |= keys  # 失敗的列留到下次再送
+        return ok
+
+    async def run_periodic(self, stop, interval=SUMMARY_FLUSH_SECONDS):
+        """背景定期上傳匯總，stop (asyncio.Event) 被設定後做最後一次上傳並結束"""
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
@@ -1,57 +1,49 @@
 # 檔名: gen_data.py
-import asyncio
 import random
-from datetime import datetime, timedelta
-from fhirpy import AsyncFHIRClient
+from urllib.parse import urlencode
+from fhir_client import FHIRClient
+import run_profile
+from observation_writer import hba1c_observation, weekly_dates, write_observations, conditional_entry, post_batch, entry_status
 
 # SMART Launcher 公開伺服器
 FHIR_SERVER_URL = "https://launch.smarthealthit.org/v/r4/fhir"
+# 測試病人以 identifier 做條件式新增：重跑時沿用同一位病人，不會一直建立新病人
+DEMO_SYSTEM = "urn:kpim:demo"
+DEMO_VALUE = "MyDemo"
 
 async def main():
     print(f"🚀 連接至: {FHIR_SERVER_URL}")
-    client = AsyncFHIRClient(url=FHIR_SERVER_URL)
+    client = FHIRClient(url=FHIR_SERVER_URL)
 
     # 1. 建立病人
     print("👤 正在建立測試病人...")
     try:
-        p = client.resource('Patient', name=[{'family': 'Test', 'given': ['MyDemo']}])
-        await p.save()
-        pid = p.id
-        print(f"✅ 病人建立成功！ID: {pid}")
+        patient = {
+            'resourceType': 'Patient',
+            'identifier': [{'system': DEMO_SYSTEM, 'value': DEMO_VALUE}],
+            'name': [{'family': 'Test', 'given': ['MyDemo']}]
+        }
+        [result] = await post_batch(client, [conditional_entry(patient, urlencode({'identifier': f"{DEMO_SYSTEM}|{DEMO_VALUE}"}))])
+        if entry_status(result) >= 300: raise RuntimeError(result.get('response'))
+        # location 可能是相對 (Patient/123/_history/1) 或絕對網址，取 Patient/ 後面那一段
+        segments = result['response']['location'].split('/')
+        pid = segments[segments.index('Patient') + 1]
+        print(f"✅ 病人{'建立成功' if entry_status(result) == 201 else '已存在'}！ID: {pid}")
     except Exception as e:
         print(f"❌ 建立失敗: {e}")
         return
 
     # 2. 準備 100 筆 HbA1c 數據
     print("📦 準備生成 100 筆數據...")
-    observations = []
-    base_date = datetime.now()
-    
-    for i in range(100):
-        # 日期遞減 (每週一筆)
-        date_str = (base_date - timedelta(weeks=i)).strftime('%Y-%m-%dT%H:%M:%S+00:00')
-        
-        # 數值波動模擬 (5.0 ~ 9.0)
-        val = round(6.0 + random.uniform(-1.0, 3.0), 1)
-        
-        obs = client.resource(
-            'Observation',
-            status='final',
-            code={'coding': [{'system': 'http://loinc.org', 'code': '4548-4'}]}, # HbA1c
-            subject={'reference': f'Patient/{pid}'},
-            effectiveDateTime=date_str,
-            valueQuantity={'value': val, 'unit': '%', 'code': '%'}
-        )
-        observations.append(obs)
+    # 日期遞減 (每週一筆，對齊週一)；數值波動模擬 (5.0 ~ 9.0)
+    observations = [
+        hba1c_observation(pid, date_str, round(6.0 + random.uniform(-1.0, 3.0), 1))
+        for date_str in weekly_dates(100)
+    ]
 
-    # 3. 批次寫入
+    # 3. 批次寫入 (batch Bundle + ifNoneExist，重跑不會重複)
     print("📤 開始上傳數據 (請稍候)...")
-    # 分批上傳以免 timeout
-    chunk_size = 20
-    for i in range(0, len(observations), chunk_size):
-        chunk = observations[i:i + chunk_size]
-        await asyncio.gather(*[o.save() for o in chunk])
-        print(f"   已寫入 {min(i + chunk_size, 100)}/100 筆")
+    await write_observations(client, observations)
 
     print("\n" + "="*40)
     print(f"🎉 資料生成完畢！請複製下方的 Patient ID")
@@ -59,4 +51,4 @@ async def main():
     print("="*40)
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    run_profile.run('test_fhir_import_data', main)
\ No newline at end of file
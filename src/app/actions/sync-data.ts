@@ -1,9 +1,19 @@
 "use server";
 
+import { createHash } from "crypto";
 import { createClient } from "@/utils/supabase/server";
 
 // Hardcoded for now, same as Python script
 const FHIR_SERVER_URL = "https://launch.smarthealthit.org/v/r4/fhir";
+const SOURCE_SYSTEM = FHIR_SERVER_URL;
+const PAGE_SIZE = 200;
+const SELECT_PAGE_SIZE = 1000;
+const UPSERT_CHUNK_SIZE = 500;
+// Delete filters go in the URL; keep each request well under the usual 8 KB request-line limit
+const MAX_FILTER_LENGTH = 6000;
+
+type SupabaseClient = Awaited<ReturnType<typeof createClient>>;
+
 // 180 days ago
 const getStartDate = () => {
     const d = new Date();
@@ -22,21 +32,85 @@ async function fetchFhir(url: string) {
     }
 }
 
+// Follow the Bundle "next" links to the last page.
+// complete = false when any page failed, so callers must not treat missing rows as deleted.
+async function fetchAllPages(url: string) {
+    const resources: any[] = [];
+    let next: string | undefined = url;
+    while (next) {
+        const bundle = await fetchFhir(next);
+        if (!bundle) return { resources, complete: false };
+        resources.push(...(bundle.entry ?? []).map((e: any) => e.resource));
+        next = bundle.link?.find((l: any) => l.relation === "next")?.url;
+    }
+    return { resources, complete: true };
+}
+
 async function fetchByIds(resourceType: string, ids: string[]) {
-    if (!ids.length) return [];
     const uniqueIds = Array.from(new Set(ids));
-    const results = [];
+    const resources: any[] = [];
+    let complete = true;
 
     // Chunk by 50
     for (let i = 0; i < uniqueIds.length; i += 50) {
         const chunk = uniqueIds.slice(i, i + 50);
         const idsStr = chunk.join(",");
-        const data = await fetchFhir(`${FHIR_SERVER_URL}/${resourceType}?_id=${idsStr}&_count=100`);
-        if (data && data.entry) {
-            results.push(...data.entry.map((e: any) => e.resource));
+        const result = await fetchAllPages(`${FHIR_SERVER_URL}/${resourceType}?_id=${idsStr}&_count=100`);
+        resources.push(...result.resources);
+        complete = complete && result.complete;
+    }
+    return { resources, complete };
+}
+
+// Row identity: source system + Procedure id + indicator (same as py/supabase_upload.py row_key)
+function rowKey(procedureId: string, indicatorName: string) {
+    return `${SOURCE_SYSTEM}|${procedureId}|${indicatorName}`;
+}
+
+// Same canonical form as py/supabase_upload.py row_hash(): sorted keys, compact JSON, SHA-256
+function rowHash(row: Record<string, any>) {
+    const content: Record<string, any> = {};
+    for (const key of Object.keys(row).sort()) {
+        if (key === "row_key" || key === "row_hash") continue;
+        content[key] = row[key] ?? null;
+    }
+    return createHash("sha256").update(JSON.stringify(content)).digest("hex");
+}
+
+// Split values into chunks whose URL-encoded "in" list stays under MAX_FILTER_LENGTH
+function chunkByLength(values: string[], maxLength = MAX_FILTER_LENGTH) {
+    const chunks: string[][] = [];
+    let chunk: string[] = [];
+    let length = 0;
+    for (const value of values) {
+        const size = encodeURIComponent(`"${value}"`).length + 3;
+        if (chunk.length && length + size > maxLength) {
+            chunks.push(chunk);
+            chunk = [];
+            length = 0;
+        }
+        chunk.push(value);
+        length += size;
+    }
+    if (chunk.length) chunks.push(chunk);
+    return chunks;
+}
+
+async function fetchStoredHashes(supabase: SupabaseClient) {
+    const stored = new Map<string, string>();
+    for (let from = 0; ; from += SELECT_PAGE_SIZE) {
+        const { data, error } = await supabase
+            .from("KPI_Detail")
+            .select("row_key, row_hash")
+            .eq("source_system", SOURCE_SYSTEM)
+            .order("row_key")
+            .range(from, from + SELECT_PAGE_SIZE - 1);
+        if (error) throw error;
+        for (const r of data ?? []) {
+            if (r.row_key) stored.set(r.row_key, r.row_hash);
         }
+        if (!data || data.length < SELECT_PAGE_SIZE) return stored;
     }
-    return results;
 }
 
 export async function syncFhirData() {
@@ -44,24 +118,25 @@ export async function syncFhirData() {
         const supabase = await createClient();
         const START_DATE = getStartDate();
 
-        // 1. Fetch Procedures
-        // Limit 200 as per Python script
-        const procUrl = `${FHIR_SERVER_URL}/Procedure?date=ge${START_DATE}&_count=200`;
-        const procBundle = await fetchFhir(procUrl);
+        // 1. Fetch Procedures (all pages, same as the Python sync)
+        const procResult = await fetchAllPages(`${FHIR_SERVER_URL}/Procedure?date=ge${START_DATE}&_count=${PAGE_SIZE}`);
+        const procedures = procResult.resources;
 
-        if (!procBundle || !procBundle.entry) {
+        if (procedures.length === 0) {
             return { success: false, message: "No procedures found on FHIR server." };
         }
 
-        const procedures = procBundle.entry.map((e: any) => e.resource);
-
         // 2. Collect IDs
         const patIds = procedures.map((p: any) => p.subject?.reference?.split('/').pop()).filter((id: string) => !!id);
         const encIds = procedures.map((p: any) => p.encounter?.reference?.split('/').pop()).filter((id: string) => !!id);
 
         // 3. Fetch Linked Resources
-        const patients = await fetchByIds("Patient", patIds);
-        const encounters = await fetchByIds("Encounter", encIds);
+        const patResult = await fetchByIds("Patient", patIds);
+        const encResult = await fetchByIds("Encounter", encIds);
+        const patients = patResult.resources;
+        const encounters = encResult.resources;
+        // Only a complete read may delete rows or overwrite the KPI summary
+        const complete = procResult.complete && patResult.complete && encResult.complete;
 
         const patMap = new Map(patients.map((p: any) => [p.id, p]));
         const encMap = new Map(encounters.map((e: any) => [e.id, e]));
@@ -118,26 +193,33 @@ export async function syncFhirData() {
             const serviceProvider = encounter.serviceProvider; // e.g., Organization/Dept
             const deptName = serviceProvider?.display || "Unknown Department";
 
-            kpiDetails.push({
+            // Same columns and value formats as to_detail_row() in py/Get_KPIM_DATA.py, so both
+            // writers produce the same row_hash for the same row_key and do not overwrite each other.
+            // Timestamps are the raw FHIR strings; age is derived from patient_birthday on display.
+            const detail: Record<string, any> = {
                 department: deptName,
                 doctor: doctorName,
                 indicator_name: "術後48小時死亡率",
                 indicator_def: "手術後死亡人數 / 手術總次數",
-                patient_id: patId,
-                patient_gender: patient.gender,
-                patient_birthday: patient.birthDate,
-                // Calculate age fallback
-                patient_age: patient.birthDate ? new Date().getFullYear() - new Date(patient.birthDate).getFullYear() : 0,
+                unit: "%",
                 status: isNumerator ? "異常" : "正常",
                 value: isNumerator ? 1 : 0,
                 numerator: isNumerator ? 1 : 0,
                 denominator: 1,
-                unit: "%",
-                report_date: opEnd.toISOString(), // Use Op Date as report date
-                admission_date: encounter.period?.start,
-                discharge_date: encounter.period?.end,
-                abnormal_reason: abnormalReason
-            });
+                patient_id: patId,
+                patient_gender: patient.gender ?? null,
+                patient_birthday: patient.birthDate ?? null,
+                report_date: opEndStr, // Use Op Date as report date
+                admission_date: encounter.period?.start ?? null,
+                discharge_date: encounter.period?.end ?? null,
+                op_end: opEndStr,
+                abnormal_reason: abnormalReason,
+                source_system: SOURCE_SYSTEM,
+                procedure_id: proc.id
+            };
+            detail.row_key = rowKey(proc.id, detail.indicator_name);
+            detail.row_hash = rowHash(detail);
+            kpiDetails.push(detail);
         }
 
         if (kpiDetails.length === 0) {
@@ -171,30 +253,59 @@ export async function syncFhirData() {
             value: item.denominator > 0 ? parseFloat(((item.numerator / item.denominator) * 100).toFixed(2)) : 0
         }));
 
-        // 6. DB Operations
-        // Clear old? Be careful. "Sync" usually implies pulling latest.
-        // But to match Generator behavior and ensure clean state as per user context, we might clear or upsert.
-        // The generator clears everything. A Sync might want to be additive?
-        // Let's safe-bet on Upsert/Insert without clearing ALL, or follow user preference.
-        // The user request was "clear before generate". Sync is "Sync".
-        // However, if we don't clear, we might duplicate details if we don't have PKs.
-        // KPI_Detail has ID pk generated by default. If we insert based on FHIR, we don't have a stable mapping to our DB ID unless we store FHIR ID.
-        // We do store 'patient_id'. Ideally we'd avoid duplicates.
-        // For now, to keep it simple and robust (like a "Refresh" button), let's CLEAR too, or assume this is a "Re-fetch all" operation.
-        // But `generateData.ts` clears all. If I create a "Sync" that doesn't clear, it might be confusing.
-        // Let's replicate the "Refresh" behavior: Clear relevant data or all data.
-        // Actually, let's just Insert new ones. IF the user wants clear, they can use Generate. O wait, Sync is separate.
-        // Let's add a "Clear" step here too for safety, assuming this is a "Reload" action.
-        await supabase.from("KPI").delete().neq("id", -1);
-        await supabase.from("KPI_Detail").delete().neq("id", -1);
-
-        const { error: kpiError } = await supabase.from("KPI").upsert(kpiSummaryList, { onConflict: "department, doctor, indicator_name" });
-        if (kpiError) throw kpiError;
-
-        const { error: detailError } = await supabase.from("KPI_Detail").insert(kpiDetails);
-        if (detailError) throw detailError;
-
-        return { success: true, message: `同步完成: ${kpiDetails.length} 筆明細，${kpiSummaryList.length} 筆匯總` };
+        // 6. DB Operations (diff-only)
+        // Compare row hashes with what is stored for this source system and only send
+        // inserted/changed rows, then delete rows that no longer exist on the FHIR side.
+        // A partial read (some FHIR page failed) only upserts what it saw: rows it missed are not
+        // deleted and the summary, which would be computed from partial data, is left untouched.
+        const stored = await fetchStoredHashes(supabase);
+        const changed = kpiDetails.filter(d => stored.get(d.row_key) !== d.row_hash);
+        const seen = new Set(kpiDetails.map(d => d.row_key));
+        const stale = complete ? Array.from(stored.keys()).filter(k => !seen.has(k)) : [];
+
+        if (complete) {
+            const { error: kpiError } = await supabase.from("KPI").upsert(kpiSummaryList, { onConflict: "department, doctor, indicator_name" });
+            if (kpiError) throw kpiError;
+        }
+
+        for (let i = 0; i < changed.length; i += UPSERT_CHUNK_SIZE) {
+            const { error: detailError } = await supabase
+                .from("KPI_Detail")
+                .upsert(changed.slice(i, i + UPSERT_CHUNK_SIZE), { onConflict: "row_key" });
+            if (detailError) throw detailError;
+        }
+
+        // Full row_keys are long (source URL + encoded indicator name), so delete by
+        // source_system + indicator_name + procedure_id instead, same as the Python sync
+        const staleByIndicator = new Map<string, string[]>();
+        for (const key of stale) {
+            const [procedureId, indicatorName] = key.slice(SOURCE_SYSTEM.length + 1).split("|");
+            if (!staleByIndicator.has(indicatorName)) staleByIndicator.set(indicatorName, []);
+            staleByIndicator.get(indicatorName)!.push(procedureId);
+        }
+        for (const [indicatorName, procedureIds] of staleByIndicator) {
+            for (const chunk of chunkByLength(procedureIds)) {
+                const { error: deleteError } = await supabase
+                    .from("KPI_Detail")
+                    .delete()
+                    .eq("source_system", SOURCE_SYSTEM)
+                    .eq("indicator_name", indicatorName)
+                    .in("procedure_id", chunk);
+                if (deleteError) throw deleteError;
+            }
+        }
+
+        const unchanged = kpiDetails.length - changed.length;
+        if (!complete) {
+            return {
+                success: false,
+                message: `部分 FHIR 資料讀取失敗: 已更新 ${changed.length} 筆明細，未刪除舊資料也未更新匯總，請重新同步`
+            };
+        }
+        return {
+            success: true,
+            message: `同步完成: ${kpiDetails.length} 筆明細 (更新 ${changed.length}、未變 ${unchanged}、刪除 ${stale.length})，${kpiSummaryList.length} 筆匯總`
+        };
 
     } catch (e) {
         console.error("Sync Error:", e);
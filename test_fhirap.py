@@ -3,34 +3,26 @@ import random
 import time
 import json
 import os
+import sys
 from datetime import datetime, timedelta
-from fhirpy import AsyncFHIRClient
-import urllib3
 
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'py'))
+from run_journal import RunJournal
+from fhir_client import FHIRClient
+from adaptive_limit import map_bounded
+import run_metrics as metrics
+import run_profile
+from supabase_upload import load_env, upsert_supabase, keyed_row, BatchUploader, KPISummary, DETAIL_CONFLICT_KEY, KPI_CONFLICT_KEY
 
 FHIR_SERVER_URL = "https://launch.smarthealthit.org/v/r4/fhir"
 TOTAL_CASES = 300 
 DAYS_BACK = 180
-
-# Load env vars from .env.local manually
-def load_env():
-    try:
-        with open('.env.local', 'r') as f:
-            for line in f:
-                if '=' in line and not line.startswith('#'):
-                    key, val = line.strip().split('=', 1)
-                    val = val.strip('"').strip("'")
-                    os.environ[key] = val
-        print("Env vars loaded from .env.local")
-    except Exception as e:
-        print(f"No .env.local found or error reading it: {e}")
+UPLOAD_BATCH_SIZE = 500
+# True: 明細邊寫 FHIR 邊上傳、匯總定期更新；False: 全部寫完才一次上傳
+PIPELINE_UPLOAD = True
 
 load_env()
 
-SUPABASE_URL = os.environ.get("NEXT_PUBLIC_SUPABASE_URL")
-SUPABASE_KEY = os.environ.get("NEXT_PUBLIC_SUPABASE_ANON_KEY")
-
 # 定義三家醫院架構
 HOSPITALS = [
     {"code": "TP_GEN", "name": "台北綜合醫院", "risk": 1.0},
@@ -53,10 +45,11 @@ def get_long_id():
     rand = str(random.randint(1000, 9999))
     return f"{prefix}{ts}{rand}"
 
-async def create_infrastructure(client):
-    print("🏥 建立組織與帳號系統...")
+def plan_infrastructure():
+    """規劃組織、醫師與帳號 (只產生 ID 與內容，尚未寫入 FHIR)"""
     infra = {}
     auth_db = [] # 用來存帳號資訊
+    resources = [] # (resource_type, 內容) 依寫入順序排列
     
     for hosp in HOSPITALS:
         h_code = hosp['code']
@@ -64,8 +57,7 @@ async def create_infrastructure(client):
         
         # 建立醫院本身的 Organization (作為院長室權限依據)
         hosp_org_id = get_long_id()
-        hosp_org = client.resource('Organization', id=hosp_org_id, name=hosp['name'], type=[{'text': 'Hospital'}])
-        await hosp_org.save()
+        resources.append(('Organization', {'id': hosp_org_id, 'name': hosp['name'], 'type': [{'text': 'Hospital'}]}))
         
         # 加入 Auth DB (院長帳號)
         auth_db.append({
@@ -79,8 +71,7 @@ async def create_infrastructure(client):
             # 建立科別
             dept_org_id = get_long_id()
             full_dept_name = f"【{hosp['name']}】{d_info['name']}"
-            org = client.resource('Organization', id=dept_org_id, name=full_dept_name, partOf={'reference': f"Organization/{hosp_org_id}"})
-            await org.save()
+            resources.append(('Organization', {'id': dept_org_id, 'name': full_dept_name, 'partOf': {'reference': f"Organization/{hosp_org_id}"}}))
             
             dept_docs = []
             for surname in d_info['docs']:
@@ -88,8 +79,7 @@ async def create_infrastructure(client):
                 doc_name = f"{surname}醫師"
                 full_name = f"{doc_name} ({hosp['name'][:2]})"
                 
-                prac = client.resource('Practitioner', id=doc_id, name=[{'text': full_name}])
-                await prac.save()
+                resources.append(('Practitioner', {'id': doc_id, 'name': [{'text': full_name}]}))
                 dept_docs.append(doc_id)
                 
                 # 加入 Auth DB (醫師帳號)
@@ -108,9 +98,26 @@ async def create_infrastructure(client):
                 'doc_names': {doc_id: f"{surname}醫師" for surname, doc_id in zip(d_info['docs'], dept_docs)}
             })
             
-    return infra, auth_db
+    return infra, auth_db, resources
+
+async def create_infrastructure(client, journal):
+    print("🏥 建立組織與帳號系統...")
+    # 先記錄規劃再寫入：中斷後以相同 ID 重新 PUT，不會產生重複的組織或醫師
+    plan = journal.get('infra', 'plan')
+    if plan is None:
+        infra, auth_db, resources = plan_infrastructure()
+        plan = {'infra': infra, 'auth_db': auth_db, 'resources': resources}
+        journal.record('infra', 'plan', plan)
 
-async def generate_case(client, infra, day_index):
+    if not journal.has('infra', 'done'):
+        for resource_type, body in plan['resources']:
+            await client.resource(resource_type, **body).save()
+        journal.record('infra', 'done')
+            
+    return plan['infra'], plan['auth_db']
+
+def plan_case(infra, day_index):
+    """規劃單一手術案例：決定所有隨機值與 ID，回傳待寫入資源與 KPI 明細"""
     # Select random hospital, dept, doctor
     hosp_code = random.choice(list(infra.keys()))
     h_data = infra[hosp_code]
@@ -140,39 +147,36 @@ async def generate_case(client, infra, day_index):
     is_deceased = False
     abnormal_reason = None
     
-    # FHIR Write
+    # FHIR Resources
     pat_id = get_long_id()
     gender = random.choice(['male', 'female'])
-    pat = client.resource('Patient', id=pat_id, gender=gender)
+    pat = {'id': pat_id, 'gender': gender}
     if is_bad: 
         death_time = op_end + timedelta(hours=random.randint(2, 46))
         pat['deceasedDateTime'] = death_time.strftime('%Y-%m-%dT%H:%M:%S+00:00')
         is_deceased = True
         abnormal_reason = "術後48小時內死亡"
-    await pat.save()
     
     enc_id = get_long_id()
-    enc = client.resource(
-        'Encounter', id=enc_id, status='finished',
-        class_={'code': 'IMP'}, subject={'reference': f"Patient/{pat_id}"},
-        serviceProvider={'reference': f"Organization/{dept['org_id']}", 'display': dept['org_name']}
-    )
+    enc = {
+        'id': enc_id, 'status': 'finished',
+        'class_': {'code': 'IMP'}, 'subject': {'reference': f"Patient/{pat_id}"},
+        'serviceProvider': {'reference': f"Organization/{dept['org_id']}", 'display': dept['org_name']}
+    }
     if is_bad: enc['hospitalization'] = {'dischargeDisposition': {'coding': [{'code': 'exp'}]}}
-    await enc.save()
     
     proc_id = get_long_id()
-    proc = client.resource(
-        'Procedure', id=proc_id, status='completed',
-        subject={'reference': f"Patient/{pat_id}"}, encounter={'reference': f"Encounter/{enc_id}"},
-        performedPeriod={'end': op_end.strftime('%Y-%m-%dT%H:%M:%S+00:00')},
-        code={'coding': [{'display': 'Surgery'}]},
-        performer=[{'actor': {'reference': f"Practitioner/{doc_id}"}}]
-    )
-    await proc.save()
+    proc = {
+        'id': proc_id, 'status': 'completed',
+        'subject': {'reference': f"Patient/{pat_id}"}, 'encounter': {'reference': f"Encounter/{enc_id}"},
+        'performedPeriod': {'end': op_end.strftime('%Y-%m-%dT%H:%M:%S+00:00')},
+        'code': {'coding': [{'display': 'Surgery'}]},
+        'performer': [{'actor': {'reference': f"Practitioner/{doc_id}"}}]
+    }
 
     # Collect Data for KPI
     # Indicator: Surgery Mortality (手術死亡率)
-    KPI_DETAILS_BUFFER.append({
+    detail = {
         "hospital": hosp_name,
         "department": dept_name,
         "doctor": doc_name,
@@ -182,6 +186,7 @@ async def generate_case(client, infra, day_index):
         "denominator": 1,
         "value": 1 if is_deceased else 0,
         "patient_id": pat_id,
+        "procedure_id": proc_id,
         "gender": gender,
         "abnormal": is_deceased,
         "timestamp": op_start.isoformat(),
@@ -190,52 +195,111 @@ async def generate_case(client, infra, day_index):
         "admission_date": admission_date.isoformat(),
         "discharge_date": discharge_date.isoformat(),
         "abnormal_reason": abnormal_reason
-    })
+    }
 
-def upsert_supabase(table, data):
-    if not SUPABASE_URL or not SUPABASE_KEY:
-        print(f"Skipping Supabase upload for {table}: Missing Credentials")
+    return {
+        'resources': [('Patient', pat), ('Encounter', enc), ('Procedure', proc)],
+        'detail': detail
+    }
+
+async def generate_case(client, infra, journal, case_no, sink=None):
+    # 已完成的案例：只從日誌還原 KPI 明細
+    if journal.has('case_done', case_no):
+        detail = journal.get('case', case_no)['detail']
+        KPI_DETAILS_BUFFER.append(detail)
+        if sink: await sink(case_no, detail)
         return
 
-    headers = {
-        "apikey": SUPABASE_KEY,
-        "Authorization": f"Bearer {SUPABASE_KEY}",
-        "Content-Type": "application/json",
-        "Prefer": "resolution=merge-duplicates" 
-    }
-    
-    url = f"{SUPABASE_URL}/rest/v1/{table}"
-    
-    # Simple Loop upload to avoid batch limits or just send whole batch if small enough
-    # Supabase REST usually handles array body as insert.
-    try:
-        http = urllib3.PoolManager()
-        encoded_data = json.dumps(data)
-        resp = http.request('POST', url, body=encoded_data, headers=headers)
-        if resp.status >= 300:
-             print(f"Error uploading to {table}: {resp.status} - {resp.data.decode('utf-8')}")
+    # 已規劃但未完成的案例沿用原本的 ID 重寫 (PUT 具冪等性)
+    plan = journal.get('case', case_no)
+    if plan is None:
+        plan = plan_case(infra, random.randint(0, DAYS_BACK))
+        journal.record('case', case_no, plan)
+
+    # FHIR Write
+    with metrics.span('generate.case'):
+        for resource_type, body in plan['resources']:
+            await client.resource(resource_type, **body).save()
+    metrics.add_rows('generate.case', 1)
+
+    journal.record('case_done', case_no)
+    KPI_DETAILS_BUFFER.append(plan['detail'])
+    if sink: await sink(case_no, plan['detail'])
+
+async def upload_batches(journal, table, data, on_conflict):
+    """分批上傳，日誌記錄每批成功上傳的列鍵值 (on_conflict 欄位)，重新執行時只略過確實上傳過的列
+    (KPI_DETAILS_BUFFER 依案例完成的先後累積，每次執行順序都不同，不能用批次編號判斷)"""
+    kind = f"upload:{table}"
+    row_id = lambda row: "|".join(str(row[f]) for f in on_conflict)
+    done = {k for keys in journal.entries(kind).values() for k in keys}
+    batch_no = len(journal.entries(kind))
+    pending = [row for row in data if row_id(row) not in done]
+    ok = True
+    for i in range(0, len(pending), UPLOAD_BATCH_SIZE):
+        batch = pending[i:i + UPLOAD_BATCH_SIZE]
+        with metrics.span(f"upload.{table}"):
+            uploaded = await upsert_supabase(table, batch, on_conflict)
+        if uploaded:
+            metrics.add_rows(f"upload.{table}", len(batch))
+            journal.record(kind, batch_no, [row_id(row) for row in batch])
+            batch_no += 1
         else:
-             print(f"Uploaded {len(data)} records to {table}")
-    except Exception as e:
-        print(f"Exception uploading to {table}: {e}")
+            ok = False
+    return ok
 
-async def main():
-    print("🚀 生成資料並建立帳號表...")
-    client = AsyncFHIRClient(url=FHIR_SERVER_URL)
-    infra, auth_db = await create_infrastructure(client)
-    
-    tasks = [generate_case(client, infra, random.randint(0, DAYS_BACK)) for _ in range(TOTAL_CASES)]
-    
-    # 分批執行
-    for i in range(0, len(tasks), 50):
-        await asyncio.gather(*tasks[i:i+50])
-        print(f"進度: {min(i+50, TOTAL_CASES)}/{TOTAL_CASES}")
+# KPI_Detail Table Mapping
+# (科別、指標名稱、指標公式、指標說明、指標類別、指標單位、指標類型、指標狀態、醫師、指標值，分子/分母值，病患個資(病患代碼、姓別、生日（年齡))
+def to_detail_row(d):
+    # row_key (來源 + Procedure id + 指標) 讓重跑或續跑的上傳覆寫同一列而不是重複新增
+    return keyed_row({
+        "department": d['department'],
+        "doctor": d['doctor'],
+        "indicator_name": d['indicator_name'],
+        "indicator_def": d['indicator_def'],
+        # "formula": "...",
+        # "category": "...",
+        "unit": d['unit'],
+        "status": d['status'], # 正常/異常
+        "value": d['value'],
+        "numerator": d['numerator'],
+        "denominator": d['denominator'],
+        "patient_id": d['patient_id'],
+        "patient_gender": d['gender'],
+        # "patient_age": ...,
+        "report_date": d['timestamp'],
+        "admission_date": d['admission_date'],
+        "discharge_date": d['discharge_date'],
+        "abnormal_reason": d['abnormal_reason']
+    }, FHIR_SERVER_URL, d['procedure_id'])
+
+async def generate_all(client, infra, journal, sink=None):
+    cases = map_bounded(lambda case_no: generate_case(client, infra, journal, case_no, sink), range(TOTAL_CASES))
+    done = 0
+    async for _ in cases:
+        done += 1
+        if done % 50 == 0 or done == TOTAL_CASES:
+            print(f"進度: {done}/{TOTAL_CASES}")
+
+async def generate_pipelined(client, infra, journal):
+    """管線模式：明細列由 generate_case 直接串流給背景上傳器，與 FHIR 寫入重疊執行"""
+    summary = KPISummary()
+    stop = asyncio.Event()
+    flusher = asyncio.create_task(summary.run_periodic(stop))
+
+    async with BatchUploader("KPI_Detail", UPLOAD_BATCH_SIZE, journal=journal) as uploader:
+        async def sink(case_no, detail):
+            row = to_detail_row(detail)
+            summary.add(row)
+            await uploader.put(case_no, row)
+
+        await generate_all(client, infra, journal, sink)
+        print("⏳ FHIR 寫入完成，等待剩餘明細上傳...")
 
-    print("\n✅ 資料生成完畢！請複製下方的 JSON 到 React 專案中使用：")
-    print("="*60)
-    print(json.dumps(auth_db, ensure_ascii=False, indent=2))
-    print("="*60)
+    stop.set()
+    await flusher
+    return uploader.failed_rows == 0 and summary.pending == 0
 
+async def upload_at_end(journal):
     # Prepare KPI Summary
     # Key: (hospital, department, doctor, indicator_name)
     summary_map = {}
@@ -288,33 +352,39 @@ async def main():
             # "hospital": k['hospital'] # If table has it
         })
     
-    # KPI_Detail Table Mapping
-    # (科別、指標名稱、指標公式、指標說明、指標類別、指標單位、指標類型、指標狀態、醫師、指標值，分子/分母值，病患個資(病患代碼、姓別、生日（年齡))
-    detail_upload = []
-    for d in KPI_DETAILS_BUFFER:
-        detail_upload.append({
-            "department": d['department'],
-            "doctor": d['doctor'],
-            "indicator_name": d['indicator_name'],
-            "indicator_def": d['indicator_def'],
-            # "formula": "...",
-            # "category": "...",
-            "unit": d['unit'],
-            "status": d['status'], # 正常/異常
-            "value": d['value'],
-            "numerator": d['numerator'],
-            "denominator": d['denominator'],
-            "patient_id": d['patient_id'],
-            "patient_gender": d['gender'],
-            # "patient_age": ...,
-            "report_date": d['timestamp'],
-            "admission_date": d['admission_date'],
-            "discharge_date": d['discharge_date'],
-            "abnormal_reason": d['abnormal_reason']
-        })
+    detail_upload = [to_detail_row(d) for d in KPI_DETAILS_BUFFER]
+
+    kpi_ok = await upload_batches(journal, "KPI", kpi_upload, KPI_CONFLICT_KEY)
+    detail_ok = await upload_batches(journal, "KPI_Detail", detail_upload, DETAIL_CONFLICT_KEY)
+    return kpi_ok and detail_ok
 
-    upsert_supabase("KPI", kpi_upload)
-    upsert_supabase("KPI_Detail", detail_upload)
+async def main():
+    with metrics.run('test_fhirap'):
+        print("🚀 生成資料並建立帳號表...")
+        client = FHIRClient(url=FHIR_SERVER_URL)
+        journal = RunJournal('test_fhirap', meta={'server': FHIR_SERVER_URL, 'total_cases': TOTAL_CASES})
+        with metrics.span('generate.infrastructure'):
+            infra, auth_db = await create_infrastructure(client, journal)
+    
+        if PIPELINE_UPLOAD:
+            print("\n📊 管線模式：KPI 資料邊生成邊上傳至 Supabase...")
+            upload_ok = await generate_pipelined(client, infra, journal)
+        else:
+            await generate_all(client, infra, journal)
+
+        print("\n✅ 資料生成完畢！請複製下方的 JSON 到 React 專案中使用：")
+        print("="*60)
+        print(json.dumps(auth_db, ensure_ascii=False, indent=2))
+        print("="*60)
+
+        if not PIPELINE_UPLOAD:
+            upload_ok = await upload_at_end(journal)
+
+        if upload_ok:
+            journal.finish()
+        else:
+            journal.close()
+            print(f"⚠️ 部分批次上傳失敗，重新執行即可從日誌續傳 ({journal.path})")
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    run_profile.run('test_fhirap', main)
\ No newline at end of file